@@ -11,7 +11,7 @@ v.02
 ---------------------------------------
 '''
 from libs.DroneBLib import DroneB
-from libs.DroneBLib import exiting, current_frame
+from libs.DroneBLib import exiting
 import cv2
 
 def main():
@@ -22,10 +22,12 @@ def main():
     # The start of this loop should be exactly as it's shown below. Any changes and it might not work
     # as expected. Use the CV image however you want to analyze drone video and call drone functions 
     # to move drone as desired.
+    seq = 0 # Sequence number of the last frame processed
     while exiting.get() == False: # Loop until exiting is signaled
-        db.process_keyboard()  # Process keystrokes
-        lcurrent_frame = current_frame.get() # Get video frame
-        if lcurrent_frame != None:
+        db.process_keyboard(0)  # Process keystrokes
+        new_frame = db.wait_for_frame(seq, 0.05) # Wait for a new video frame
+        if new_frame is not None:
+            lcurrent_frame, seq, stamp = new_frame
             image = db.process_frame(lcurrent_frame) # Process
             # Change nothing above here!  Use image however you 
             # want to analyze drone position, movement, etc.
@@ -0,0 +1,41 @@
+'''
+DBAsync.py - Drives the drone from one asyncio event
+loop: video, vision and telemetry each run as their
+own task and wake up only when there's something new.
+Press 'C' to have the drone follow a blue square.
+
+(c)2022. Brett Huffman
+v.02
+---------------------------------------
+'''
+import asyncio
+from libs.AsyncDroneB import AsyncDroneB
+from libs.Color import ColorFinder
+
+async def video(adb, tracker):
+    # Same blue as DBTrack.py
+    finder = ColorFinder([52,94,30], [180,255,130])
+    async for frame, seq, stamp in adb.frames():
+        image = adb.show(frame)
+        rect = finder.find(image)
+        if rect is not None and rect[2] > 40 and rect[3] > 40:
+            tracker.update_rect(rect, image.shape, stamp)
+
+async def flight_data(adb):
+    async for sample in adb.telemetry():
+        if sample.battery is not None and sample.battery < 20:
+            print("Battery low:", sample.battery)
+
+async def main():
+    adb = AsyncDroneB()
+    await adb.connect(window = True)
+    tracker = adb.db.start_tracking()
+    tracker.enabled = False
+    adb.db.controls['c'] = tracker.toggle
+    try:
+        await asyncio.gather(video(adb, tracker), flight_data(adb))
+    finally:
+        await adb.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,306 @@
+'''
+DBBench.py - Times every stage of the video pipeline, from packet
+demux to the pixels shown by process_frame, on recorded clips.  No
+drone is needed.  Reports p50/p95/p99 latency per stage and the
+sustained fps, and saves the numbers to a JSON results file that
+later runs can be compared against to catch regressions.
+
+    python DBBench.py                       (synthetic 720p and 960x720 clips)
+    python DBBench.py flight1.mp4 flight2.h264
+    python DBBench.py --out new.json --baseline old.json
+
+It also times a headless start-up, from importing DroneBLib to the
+first decoded frame, in a fresh interpreter each run.
+
+(c)2022. Brett Huffman
+v.02
+---------------------------------------
+'''
+import os
+import sys
+import time
+import json
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+import av
+import cv2
+import numpy
+import pygame
+from libs.DroneBLib import DroneB, SafeFrame, SyntheticVideo, frame_to_ndarray
+from libs.QR import QRReader
+from libs.Color import ColorFinder
+try:
+    import PIL # only needed to time the old to_image() path
+except ImportError:
+    PIL = None
+
+# Stages of the live pipeline - their sum gives the sustained fps
+LIVE_STAGES = ('demux', 'decode', 'ndarray', 'display', 'hud')
+# Stages timed for comparison (old PIL path) or that depend on the demo
+OTHER_STAGES = ('pil', 'cvtcolor', 'rotate', 'track', 'qr')
+RESULTS_VERSION = 1
+
+# Run in a fresh interpreter: import, open the clip with no window,
+# wait for the first frame.  Prints import s, first frame s and which
+# of the slow optional modules got loaded.
+STARTUP_SCRIPT = '''
+import sys, time
+t0 = time.perf_counter()
+from libs.DroneBLib import DroneB
+t1 = time.perf_counter()
+db = DroneB(source=sys.argv[1], realtime=False)
+db.start(custom_loop=True, window=False)
+db.wait_for_frame(0, 30)
+t2 = time.perf_counter()
+print('startup', t1 - t0, t2 - t0, ','.join(m for m in ('cv2', 'pygame', 'tellopy') if m in sys.modules))
+db.quit()
+'''
+
+class StageTimer(object):
+    ''' Collects per-stage timings in seconds '''
+    def __init__(self):
+        self.times = {}
+
+    def add(self, stage, seconds):
+        self.times.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        stats = {}
+        for stage, times in self.times.items():
+            ms = numpy.array(times) * 1000.0
+            stats[stage] = {
+                'n': len(times),
+                'mean_ms': round(float(ms.mean()), 4),
+                'p50_ms': round(float(numpy.percentile(ms, 50)), 4),
+                'p95_ms': round(float(numpy.percentile(ms, 95)), 4),
+                'p99_ms': round(float(numpy.percentile(ms, 99)), 4),
+            }
+        return stats
+
+def make_clip(path, width, height, count):
+    ''' Encodes a synthetic H.264 clip to benchmark against '''
+    out = av.open(path, 'w')
+    stream = out.add_stream('h264', rate=30)
+    stream.width = width
+    stream.height = height
+    stream.pix_fmt = 'yuv420p'
+    for image in SyntheticVideo(width, height, count).frames():
+        for packet in stream.encode(av.VideoFrame.from_ndarray(image, 'bgr24')):
+            out.mux(packet)
+    for packet in stream.encode():
+        out.mux(packet)
+    out.close()
+
+def bench_clip(db, path, vision = True):
+    ''' Runs one clip through every stage and returns its results '''
+    timer = StageTimer()
+    ring = SafeFrame()
+    finder = ColorFinder([52,94,30], [180,255,130]) # as used by DBTrack.py
+    reader = QRReader() # as used by DBQR.py
+    background = pygame.display.get_surface()
+    clock = time.perf_counter
+
+    container = av.open(path)
+    stream = container.streams.video[0]
+    packets = container.demux((stream,))
+    frames = 0
+    size = None
+    while True:
+        t = clock()
+        packet = next(packets, None)
+        timer.add('demux', clock() - t)
+        if packet is None:
+            break
+
+        t = clock()
+        decoded = packet.decode()
+        timer.add('decode', clock() - t)
+
+        for frame in decoded:
+            frames += 1
+            size = '{}x{}'.format(frame.width, frame.height)
+
+            # Old path: PIL image, then RGB -> BGR
+            if PIL is not None:
+                t = clock()
+                pil_image = frame.to_image()
+                timer.add('pil', clock() - t)
+                rgb = numpy.array(pil_image)
+            else:
+                rgb = frame.to_ndarray(format='rgb24')
+            t = clock()
+            cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+            timer.add('cvtcolor', clock() - t)
+
+            # Current path: one conversion straight into the frame ring
+            t = clock()
+            ring.set(frame_to_ndarray(frame, db.frame_format))
+            image = ring.get()
+            timer.add('ndarray', clock() - t)
+
+            t = clock()
+            cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+            timer.add('rotate', clock() - t)
+
+            t = clock()
+            db.show_hud = False
+            db.process_frame(image)
+            timer.add('display', clock() - t)
+
+            t = clock()
+            db.draw_hud(background, 0, 0)
+            timer.add('hud', clock() - t)
+
+            if vision:
+                t = clock()
+                finder.find(image)
+                timer.add('track', clock() - t)
+
+                t = clock()
+                reader.read(image)
+                timer.add('qr', clock() - t)
+    container.close()
+
+    stages = timer.summary()
+    live = sum(sum(timer.times.get(stage, [])) for stage in LIVE_STAGES)
+    result = {
+        'clip': os.path.basename(path),
+        'size': size,
+        'frames': frames,
+        'fps': round(frames / live, 2) if live > 0 else None,
+        'stages': stages,
+    }
+    if vision and live > 0:
+        vision_time = sum(timer.times['track']) + sum(timer.times['qr'])
+        result['fps_with_vision'] = round(frames / (live + vision_time), 2)
+    return result
+
+def bench_startup(path, runs):
+    ''' Times import and first frame of a headless DroneB, runs times '''
+    imports = []
+    first_frames = []
+    for i in range(runs):
+        out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, path], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout
+        line = [l for l in out.splitlines() if l.startswith('startup ')][0]
+        fields = line.split(' ')
+        imports.append(float(fields[1]) * 1000.0)
+        first_frames.append(float(fields[2]) * 1000.0)
+        loaded = fields[3]
+    return {
+        'runs': runs,
+        'import_ms': round(float(numpy.median(imports)), 2),
+        'first_frame_ms': round(float(numpy.median(first_frames)), 2),
+        'loaded': loaded, # cv2/pygame/tellopy should stay unloaded
+    }
+
+def compare(results, baseline, tolerance):
+    ''' Returns a list of regressions against a baseline results file '''
+    regressions = []
+    old_clips = dict((c['size'], c) for c in baseline['clips'])
+    for clip in results['clips']:
+        old = old_clips.get(clip['size'])
+        if old is None:
+            continue
+        for stage, stats in clip['stages'].items():
+            old_stats = old['stages'].get(stage)
+            if old_stats is None:
+                continue
+            if stats['p95_ms'] > old_stats['p95_ms'] * (1 + tolerance):
+                regressions.append('{} {}: p95 {:.2f} ms -> {:.2f} ms'.format(
+                    clip['size'], stage, old_stats['p95_ms'], stats['p95_ms']))
+        if old['fps'] and clip['fps'] and clip['fps'] < old['fps'] * (1 - tolerance):
+            regressions.append('{} fps: {:.1f} -> {:.1f}'.format(clip['size'], old['fps'], clip['fps']))
+    startup, old = results.get('startup'), baseline.get('startup')
+    if startup is not None and old is not None:
+        for key in ('import_ms', 'first_frame_ms'):
+            if startup[key] > old[key] * (1 + tolerance):
+                regressions.append('startup {}: {:.1f} -> {:.1f}'.format(key, old[key], startup[key]))
+    return regressions
+
+def print_results(results):
+    startup = results.get('startup')
+    if startup is not None:
+        print('\nStartup (headless, median of {}): import {:.1f} ms, first frame {:.1f} ms'.format(
+            startup['runs'], startup['import_ms'], startup['first_frame_ms']))
+        if startup['loaded']:
+            print('  loaded without being used:', startup['loaded'])
+    for clip in results['clips']:
+        print('\n{} ({}) - {} frames, {} fps sustained'.format(
+            clip['clip'], clip['size'], clip['frames'], clip['fps']))
+        if 'fps_with_vision' in clip:
+            print('  {} fps with DBTrack + DBQR vision'.format(clip['fps_with_vision']))
+        print('  {:<10}{:>10}{:>10}{:>10}{:>10}'.format('stage', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for stage in LIVE_STAGES + OTHER_STAGES:
+            if stage in clip['stages']:
+                st = clip['stages'][stage]
+                print('  {:<10}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}'.format(
+                    stage, st['mean_ms'], st['p50_ms'], st['p95_ms'], st['p99_ms']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the DroneB video pipeline')
+    parser.add_argument('clips', nargs='*', help='recorded H.264/MP4 clips (default: synthetic 1280x720 and 960x720)')
+    parser.add_argument('--frames', type=int, default=300, help='length of the synthetic clips')
+    parser.add_argument('--out', default='bench_results.json', help='where to save the results')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before a regression is reported (0.2 = 20%%)')
+    parser.add_argument('--no-vision', action='store_true', help='skip the DBTrack/DBQR vision steps')
+    parser.add_argument('--headless', action='store_true', help='render to an offscreen SDL display')
+    parser.add_argument('--startup-runs', type=int, default=5, help='fresh interpreters to time start-up in (0 to skip)')
+    args = parser.parse_args()
+
+    if args.headless:
+        # Read by SDL when the window is opened
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+
+    clips = args.clips
+    tmpdir = None
+    if len(clips) == 0:
+        tmpdir = tempfile.TemporaryDirectory()
+        for width, height in ((1280, 720), (960, 720)):
+            path = os.path.join(tmpdir.name, 'synthetic_{}x{}.mp4'.format(width, height))
+            make_clip(path, width, height, args.frames)
+            clips.append(path)
+
+    # No drone needed - the stub is enough to drive process_frame
+    db = DroneB(source='synthetic')
+    db.init_window()
+    for row in db.hud:
+        row[2] = row[1].format(0)
+
+    results = {
+        'version': RESULTS_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'frame_format': db.frame_format,
+        'clips': [bench_clip(db, path, not args.no_vision) for path in clips],
+    }
+    if args.startup_runs > 0:
+        results['startup'] = bench_startup(clips[0], args.startup_runs)
+    print_results(results)
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('\nResults saved to', args.out)
+
+    pygame.quit()
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print('\nREGRESSIONS against', args.baseline)
+            for line in regressions:
+                print('  ' + line)
+            sys.exit(1)
+        print('\nNo regressions against', args.baseline)
+
+if __name__ == '__main__':
+    main()
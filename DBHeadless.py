@@ -0,0 +1,41 @@
+'''
+DBHeadless.py - Runs vision on a computer without a
+screen (e.g. a ground station server).  No window is
+opened and no frame is drawn; the library just hands
+every frame and flight data sample to the callbacks
+below.  Stop it with Ctrl+C.
+
+    DRONEB_SOURCE=flight.mp4 python DBHeadless.py
+
+(c)2022. Brett Huffman
+v.02
+---------------------------------------
+'''
+from libs.DroneBLib import DroneB
+from libs.Color import ColorFinder
+
+def main():
+    db = DroneB()
+    finder = ColorFinder([52,94,30], [180,255,130]) # same blue as DBTrack.py
+    found = [0]
+
+    def on_frame(image, seq, stamp):
+        # image is a read-only cv2 image - copy it before drawing on it
+        rect = finder.find(image)
+        if rect is not None:
+            found[0] += 1
+            if found[0] % 30 == 1:
+                print("Frame {}: blue square at {}".format(seq, rect))
+
+    def on_telemetry(sample):
+        if sample.battery is not None and sample.battery < 20:
+            print("Battery low:", sample.battery)
+
+    try:
+        db.run_headless(on_frame, on_telemetry)
+    except KeyboardInterrupt:
+        db.quit()
+    print("Blue square seen in {} frames".format(found[0]))
+
+if __name__ == '__main__':
+    main()
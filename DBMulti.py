@@ -0,0 +1,77 @@
+'''
+DBMulti.py - Flies several drones from one program.
+Each drone has its own video, telemetry and command
+queue; one pool of vision workers looks for blue
+squares in all of them.  Give the address of each
+drone (Tello EDUs in station mode), or none to
+try it with two simulated drones (DRONEB_SOURCE
+picks what they play, synthetic video by default):
+
+    python DBMulti.py 192.168.0.11 192.168.0.12
+    python DBMulti.py
+
+Keys (in the video window): t - take off, l - land,
+q - quit.
+
+(c)2022. Brett Huffman
+v.02
+---------------------------------------
+'''
+import os
+import sys
+import cv2
+import numpy
+from libs.DroneBLib import DroneB, start_vision
+from libs.DroneBLib import exiting
+from libs.Color import ColorFinder
+
+def main():
+    addresses = sys.argv[1:]
+    source = None # real drones
+    if len(addresses) == 0:
+        addresses = [None, None] # two simulated drones
+        source = os.environ.get('DRONEB_SOURCE') or 'synthetic'
+
+    fleet = []
+    for i, address in enumerate(addresses):
+        # Every drone needs its own local ports
+        db = DroneB(name = 'tello{}'.format(i + 1), port = 9000 + 10 * i,
+                    video_port = 6038 + 10 * i, address = address,
+                    source = source)
+        db.add_detector('blue', ColorFinder([52,94,30], [180,255,130]))
+        db.start(custom_loop = True, window = False)
+        fleet.append(db)
+    # One set of worker processes for every drone's detectors
+    start_vision(fleet)
+
+    seqs = [0] * len(fleet)
+    tiles = [None] * len(fleet)
+    while exiting.get() == False: # Set once every drone has quit
+        for i, db in enumerate(fleet):
+            new_frame = db.wait_for_frame(seqs[i], 0.01)
+            if new_frame is None:
+                continue
+            lcurrent_frame, seqs[i], stamp = new_frame
+            tile = cv2.resize(db.process_frame(lcurrent_frame), (480, 360))
+            result = db.get_vision_result('blue')
+            if result is not None and result[2] is not None:
+                x, y, w, h = [v * 480 // lcurrent_frame.shape[1] for v in result[2]]
+                cv2.rectangle(tile, (x, y), (x + w, y + h), (0, 255, 0), 2)
+            cv2.putText(tile, db.name, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+            tiles[i] = tile
+
+        if all(tile is not None for tile in tiles):
+            cv2.imshow('Fleet', numpy.hstack(tiles))
+        key = cv2.waitKey(1) & 0xFF
+        if key == ord('t'):
+            for db in fleet:
+                db.drone.takeoff()
+        elif key == ord('l'):
+            for db in fleet:
+                db.drone.land()
+        elif key == ord('q'):
+            for db in fleet:
+                db.quit()
+
+if __name__ == '__main__':
+    main()
@@ -7,39 +7,46 @@ v.02
 ---------------------------------------
 '''
 from libs.DroneBLib import DroneB
-from libs.DroneBLib import exiting, current_frame
+from libs.DroneBLib import exiting
 import cv2
-from libs.QR import read_qr_code
+from libs.QR import QRReader
 
 def main():
     db = DroneB()
+    # QR detection runs in worker processes on every frame they
+    # have time for, so the video loop never waits on it
+    db.add_detector('qr', QRReader())
     db.start(custom_loop = True)
+    db.start_vision()
 
-    loop_count = 0
+    qr_seq = 0 # frame the last QR result we showed came from
     # The start of this loop should be exactly as it's shown below. Any changes and it might not work
     # as expected. Use the CV image however you want to analyze drone video and call drone functions 
     # to move drone as desired.
+    seq = 0 # Sequence number of the last frame processed
     while exiting.get() == False: # Loop until exiting is signaled
-        db.process_keyboard()  # Process keystrokes
-        lcurrent_frame = current_frame.get() # Get video frame
-        if lcurrent_frame != None:
+        db.process_keyboard(0)  # Process keystrokes
+        new_frame = db.wait_for_frame(seq, 0.05) # Wait for a new video frame
+        if new_frame is not None:
+            lcurrent_frame, seq, stamp = new_frame
             image = db.process_frame(lcurrent_frame) # Process
             # Change nothing above here!  Use image however you 
             # want to analyze drone position, movement, etc.
             # image is a CV2 image.
 
             # Here is an example to show a secondary CV2
-            # window.  loop_count keeps it updating only
-            # once per 30 frames (which is a good idea
-            # for efficiency sake.)
-            loop_count += 1
-            if loop_count % 30 == 0:
-                # Look for QR - if read put text on screen
-                val = read_qr_code(image=image)
-
-
-                cv2.putText(image, val[0], (2, 20), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 0), 2, cv2.LINE_AA)
-                cv2.rectangle(image, val[0][0], val[0][4], (0, 255, 0), 3)
+            # window, updated whenever the workers have
+            # a new QR result.
+            result = db.get_vision_result('qr')
+            if result is not None and result[0] != qr_seq:
+                qr_seq, qr_stamp, codes = result
+                image = image.copy() # frames are read-only, copy before drawing
+                # Put the text of every QR code read on screen
+                y = 20
+                for text, points in codes or []:
+                    cv2.putText(image, text, (2, y), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 0), 2, cv2.LINE_AA)
+                    cv2.polylines(image, [points.astype(int)], True, (0, 255, 0), 3)
+                    y += 30
                 # CV way of showing video
                 cv2.imshow('Secondary View', image)
                 _ = cv2.waitKey(1) & 0xFF
@@ -8,7 +8,7 @@ v.02
 ---------------------------------------
 '''
 from libs.DroneBLib import DroneB, Queue_Item
-from libs.DroneBLib import exiting, current_frame
+from libs.DroneBLib import exiting
 import cv2
 
 def main():
@@ -23,21 +23,22 @@ def main():
         db.AddNewQueueItem("right", 500)
         db.AddNewQueueItem("forward", 300)
     db.AddNewQueueItem("land", 1000)
+    # Once the command queue is enabled ('C'), the items run one-by-one
+    # on the scheduler thread until it's empty.  Each item's timing
+    # (how late it started and stopped) is printed as it finishes.
 
 
 
     # The start of this loop should be exactly as it's shown below. Any changes and it might not work
     # as expected. Use the CV image however you want to analyze drone video and call drone functions 
     # to move drone as desired.
+    seq = 0 # Sequence number of the last frame processed
     while exiting.get() == False: # Loop until exiting is signaled
-        db.process_keyboard()  # Process keystrokes
-        lcurrent_frame = current_frame.get() # Get video frame
-        if lcurrent_frame != None:
+        db.process_keyboard(0)  # Process keystrokes
+        new_frame = db.wait_for_frame(seq, 0.05) # Wait for a new video frame
+        if new_frame is not None:
+            lcurrent_frame, seq, stamp = new_frame
             image = db.process_frame(lcurrent_frame) # Process
 
-        # Once the command queue is enabled, process them
-        # one-by-one until it's empty
-        db.process_command_queue() # Process the command queue
-
 if __name__ == '__main__':
     main()
\ No newline at end of file
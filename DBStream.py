@@ -1,121 +1,59 @@
 '''
-AdvB - The more complicated example of using
-the Tello Drone Starter Library.  You must 
-specify custom_loop = True in the start()
-command.  Next, make sure to then loop which
-handles keystrokes, displaying video and
-sending commands to the drone.
+DBStream - Streams the drone's video to other
+programs on this computer as MPEG-TS over UDP,
+without any external ffmpeg process.  Watch it
+with:
+
+    ffplay -fflags nobuffer -flags low_delay udp://127.0.0.1:23000
+
+By default the drone's own H.264 video is sent
+as it is (no decoding or re-encoding).  Set
+REENCODE = True to stream the frames with your
+own drawings on them instead.
 
 (c)2022. Brett Huffman
 v.02
 ---------------------------------------
 '''
 from libs.DroneBLib import DroneB
-from libs.DroneBLib import exiting, current_frame
+from libs.DroneBLib import exiting
 import cv2
-import subprocess as sp
+
+STREAM_URL = 'udp://127.0.0.1:23000' # or rtp://127.0.0.1:23000
+REENCODE = False
 
 def main():
     db = DroneB()
     db.start(custom_loop = True)
 
     # Setup streaming
+    if REENCODE:
+        # Frames are encoded in-process; if the encoder falls
+        # behind, old frames are dropped so the stream stays live
+        db.start_restream(STREAM_URL, reencode = True, width = 640, height = 480)
+    else:
+        db.start_restream(STREAM_URL)
 
-    height, width, ch = lcurrent_frame.shape
-    height, width = 480, 600
-
-    ffmpeg = 'FFMPEG'
-    dimension = '{}x{}'.format(width, height)
-    f_format = 'bgr24' # remember OpenCV uses bgr format
-
-    command = [ffmpeg,
-            '-y',
-            '-f', 'rawvideo',
-            '-vcodec','rawvideo',
-            '-s', dimension,
-            '-pix_fmt', 'bgr24',
-            '-i', '-',
-            '-an',
-            '-v', '0',
-            '-vcodec', 'mpeg4',
-            '-b:v', '5000k',
-            '=f', 'mpegts', 'udp://127.0.0.1:23000']
-
-    proc = sp.Popen(command, stdin=sp.PIPE, stderr=sp.PIPE)
-
-    loop_count = 0
     # The start of this loop should be exactly as it's shown below. Any changes and it might not work
-    # as expected. Use the CV image however you want to analyze drone video and call drone functions 
+    # as expected. Use the CV image however you want to analyze drone video and call drone functions
     # to move drone as desired.
+    seq = 0 # Sequence number of the last frame processed
     while exiting.get() == False: # Loop until exiting is signaled
-        db.process_keyboard()  # Process keystrokes
-        lcurrent_frame = current_frame.get() # Get video frame
-        if lcurrent_frame != None:
+        db.process_keyboard(0)  # Process keystrokes
+        new_frame = db.wait_for_frame(seq, 0.05) # Wait for a new video frame
+        if new_frame is not None:
+            lcurrent_frame, seq, stamp = new_frame
             image = db.process_frame(lcurrent_frame) # Process
-            # Change nothing above here!  Use image however you 
+            # Change nothing above here!  Use image however you
             # want to analyze drone position, movement, etc.
             # image is a CV2 image.
 
-            proc.stdin.write(image.tostring())
-
-    # Close down stdin and stderr
-    proc.stdin.close()
-    proc.stderr.close()
-    proc.wait()
-
-
-            '''
-            # Use a combination of these...
-            (Stream like this)
-            $ ffmpeg -i sample.mp4 -v 0 -vcodec mpeg4 -f mpegts udp://127.0.0.1:23000
-
-            # This script copies the video frame by frame
-            import cv2
-            import subprocess as sp
-
-            input_file = 'input_file_name.mp4'
-            output_file = 'output_file_name.mp4'
-
-            cap = cv2.VideoCapture(input_file)
-            ret, frame = cap.read()
-            height, width, ch = frame.shape
-
-            ffmpeg = 'FFMPEG'
-            dimension = '{}x{}'.format(width, height)
-            f_format = 'bgr24' # remember OpenCV uses bgr format
-            fps = str(cap.get(cv2.CAP_PROP_FPS))
-
-            command = [ffmpeg,
-                    '-y',
-                    '-f', 'rawvideo',
-                    '-vcodec','rawvideo',
-                    '-s', dimension,
-                    '-pix_fmt', 'bgr24',
-                    '-r', fps,
-                    '-i', '-',
-                    '-an',
-                    '-vcodec', 'mpeg4',
-                    '-b:v', '5000k',
-                    output_file ]
-
-            proc = sp.Popen(command, stdin=sp.PIPE, stderr=sp.PIPE)
-
-            while True:
-                ret, frame = cap.read()
-                if not ret:
-                    break
-                proc.stdin.write(frame.tostring())
-
-            cap.release()
-            proc.stdin.close()
-            proc.stderr.close()
-            proc.wait()
-
-
+            if REENCODE:
+                frame = image.copy() # frames are read-only, copy before drawing
+                cv2.putText(frame, 'seq {}'.format(seq), (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+                db.restream_frame(frame, stamp)
 
-            Can check this with ffplay like this:
-            ffplay udp://127.0.0.1:23000
-            '''
+    db.stop_restream()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,202 @@
+'''
+AsyncDroneB - asyncio front end for DroneB
+(c)2022. Brett Huffman
+v.02
+---------------------------------------
+Lets vision, control and I/O share one event loop:
+
+    adb = AsyncDroneB()
+    await adb.connect()
+    async for frame, seq, stamp in adb.frames():
+        ...
+        await adb.forward(30, duration = 0.5)
+
+Frames and telemetry still come from DroneB's grab thread and tellopy's
+threads.  They wake the loop with call_soon_threadsafe() the moment
+something new arrives, so nothing here sleeps or polls waiting for them.
+---------------------------------------
+'''
+import asyncio
+from threading import Thread
+from libs.DroneBLib import DroneB, register_drone
+
+class AsyncDroneB(object):
+    '''
+    Wraps a DroneB (made from kwargs if not given).  Movement commands
+    are coroutines: with a duration they hold the speed that long and
+    then stop, even if the task is cancelled.
+    '''
+    MOVES = ('forward', 'backward', 'left', 'right', 'up', 'down', 'clockwise', 'counter_clockwise')
+
+    def __init__(self, db = None, **kwargs):
+        self.db = db if db is not None else DroneB(**kwargs)
+        self.loop = None
+        self.frame_waiters = set() # asyncio.Events of running frames() loops
+        self.telemetry_queues = set() # asyncio.Queues of running telemetry() loops
+        self.grab_thread = None
+        self.keyboard_task = None
+
+    async def connect(self, window = False):
+        '''
+        Connects to the drone (or opens the offline source) without
+        blocking the loop and starts the video.  window = True also
+        opens the pygame window and reads the keyboard controls.
+        '''
+        self.loop = asyncio.get_running_loop()
+        register_drone(self.db)
+        await self.loop.run_in_executor(None, self.db.init_drone)
+        self.db.current_frame.add_listener(self.frame_published)
+        self.db.subscribe_telemetry(self.telemetry_published)
+        self.grab_thread = Thread(target=self.db.frame_grab, args=[self.db], daemon=True)
+        self.grab_thread.start()
+        if window:
+            self.db.init_controls()
+            self.db.init_window()
+            self.keyboard_task = self.loop.create_task(self.keyboard())
+        return self
+
+    async def close(self):
+        ''' Stops the drone and every thread '''
+        self.db.current_frame.remove_listener(self.frame_published)
+        self.db.telemetry.unsubscribe(self.telemetry_published)
+        if self.keyboard_task is not None:
+            self.keyboard_task.cancel()
+        await self.loop.run_in_executor(None, self.db.quit)
+        # Let running frames() and telemetry() loops finish
+        self.wake_frames()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    # Frames
+    def frame_published(self, seq):
+        # Called on the grab thread
+        self.loop.call_soon_threadsafe(self.wake_frames)
+
+    def wake_frames(self):
+        for event in self.frame_waiters:
+            event.set()
+        if self.db.exiting.get() == True:
+            # Video is over (quit or end of a recording) - so is telemetry
+            self.queue_telemetry(None)
+
+    async def frames(self):
+        ''' Yields (frame, seq, stamp) for every new frame until exiting '''
+        event = asyncio.Event()
+        self.frame_waiters.add(event)
+        seq = 0
+        try:
+            while self.db.exiting.get() == False:
+                event.clear()
+                new_frame = self.db.current_frame.wait(seq, 0)
+                if new_frame is None:
+                    await event.wait()
+                    continue
+                seq = new_frame[1]
+                yield new_frame
+        finally:
+            self.frame_waiters.discard(event)
+
+    async def next_frame(self, after_seq = 0):
+        ''' Returns the first (frame, seq, stamp) newer than after_seq, or None when exiting '''
+        event = asyncio.Event()
+        self.frame_waiters.add(event)
+        try:
+            while self.db.exiting.get() == False:
+                event.clear()
+                new_frame = self.db.current_frame.wait(after_seq, 0)
+                if new_frame is not None:
+                    return new_frame
+                await event.wait()
+            return None
+        finally:
+            self.frame_waiters.discard(event)
+
+    def show(self, frame):
+        ''' Shows a frame in the window (see DroneB.process_frame) '''
+        return self.db.process_frame(frame)
+
+    # Telemetry
+    def telemetry_published(self, sample):
+        # Called on tellopy's thread
+        self.loop.call_soon_threadsafe(self.queue_telemetry, sample)
+
+    def queue_telemetry(self, sample):
+        for q in self.telemetry_queues:
+            if q.full():
+                q.get_nowait() # a slow reader gets the newest samples
+            q.put_nowait(sample)
+
+    async def telemetry(self, backlog = 16):
+        ''' Yields every Telemetry sample as it arrives until close() '''
+        q = asyncio.Queue(backlog)
+        self.telemetry_queues.add(q)
+        try:
+            while self.db.exiting.get() == False:
+                sample = await q.get()
+                if sample is None:
+                    break
+                yield sample
+        finally:
+            self.telemetry_queues.discard(q)
+
+    # Commands
+    async def move(self, name, speed, duration = None):
+        '''
+        Sets one of the MOVES to speed (0-100).  With a duration (seconds)
+        it waits that long and sets it back to 0.
+        '''
+        getattr(self.db.drone, name)(speed)
+        if duration is None:
+            return
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            getattr(self.db.drone, name)(0)
+
+    async def forward(self, speed, duration = None):
+        await self.move('forward', speed, duration)
+
+    async def backward(self, speed, duration = None):
+        await self.move('backward', speed, duration)
+
+    async def left(self, speed, duration = None):
+        await self.move('left', speed, duration)
+
+    async def right(self, speed, duration = None):
+        await self.move('right', speed, duration)
+
+    async def up(self, speed, duration = None):
+        await self.move('up', speed, duration)
+
+    async def down(self, speed, duration = None):
+        await self.move('down', speed, duration)
+
+    async def clockwise(self, speed, duration = None):
+        await self.move('clockwise', speed, duration)
+
+    async def counter_clockwise(self, speed, duration = None):
+        await self.move('counter_clockwise', speed, duration)
+
+    async def takeoff(self, wait = 0):
+        ''' Takes off, then waits wait seconds (e.g. for it to climb) '''
+        self.db.drone.takeoff()
+        await asyncio.sleep(wait)
+
+    async def land(self, wait = 0):
+        self.db.drone.land()
+        await asyncio.sleep(wait)
+
+    async def palm_land(self, wait = 0):
+        self.db.drone.palm_land()
+        await asyncio.sleep(wait)
+
+    async def keyboard(self):
+        # pygame has no way to wake an event loop, so its events are
+        # read at a fixed 100 Hz - the only polling left
+        while self.db.exiting.get() == False:
+            self.db.process_keyboard(0)
+            await asyncio.sleep(0.01)
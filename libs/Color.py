@@ -0,0 +1,95 @@
+import cv2
+import numpy
+
+
+class ColorFinder(object):
+    """Finds the biggest blob of one colour in BGR images.
+
+    The HSV range is compiled into threshold arrays once, and again only
+    when set_range() gets different values (e.g. from the DBFindColor
+    keys).  Masks are built on a downscaled copy of the frame and the
+    results are scaled back to full resolution.
+
+    Args:
+        lower_hsv (list): lowest H, S, V to match.  A lower hue above the
+            upper hue wraps around (e.g. 170 to 10 for reds).
+        upper_hsv (list): highest H, S, V to match
+        scale (float): size of the image the mask is built on (0.5 = half)
+        kernel_size (int): noise filter size at full resolution
+        min_area (int): smallest blob, in full resolution pixels, to report
+    """
+
+    def __init__(self, lower_hsv, upper_hsv, scale=0.5, kernel_size=5, min_area=0):
+        self.scale = scale
+        self.min_area = min_area
+        k = max(1, int(kernel_size * scale + 0.5))
+        self.kernel = numpy.ones((k, k), numpy.uint8)
+        self.range = None
+        self.bounds = []
+        self.set_range(lower_hsv, upper_hsv)
+
+    def set_range(self, lower_hsv, upper_hsv):
+        """Compiles a new HSV range.
+
+        Returns:
+            changed (bool): False if the range was already in use
+        """
+        lower = tuple(min(255, max(0, int(v))) for v in lower_hsv)
+        upper = tuple(min(255, max(0, int(v))) for v in upper_hsv)
+        if (lower, upper) == self.range:
+            return False
+        self.range = (lower, upper)
+        if lower[0] <= upper[0]:
+            self.bounds = [(numpy.array(lower, numpy.uint8), numpy.array(upper, numpy.uint8))]
+        else:
+            # Hue wraps around past 179
+            self.bounds = [
+                (numpy.array(lower, numpy.uint8), numpy.array((179, upper[1], upper[2]), numpy.uint8)),
+                (numpy.array((0, lower[1], lower[2]), numpy.uint8), numpy.array(upper, numpy.uint8)),
+            ]
+        return True
+
+    def mask(self, image):
+        """Returns the noise filtered mask of matching pixels, at the reduced scale."""
+        if self.scale != 1:
+            image = cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_NEAREST)
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        mask = cv2.inRange(hsv, self.bounds[0][0], self.bounds[0][1])
+        for lower, upper in self.bounds[1:]:
+            mask |= cv2.inRange(hsv, lower, upper)
+        return cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel)
+
+    def masked(self, image, mask=None):
+        """Returns the image with everything but the matching colour blacked out (for display)."""
+        if mask is None:
+            mask = self.mask(image)
+        mask = cv2.resize(mask, image.shape[1::-1], interpolation=cv2.INTER_NEAREST)
+        return cv2.bitwise_and(image, image, mask=mask)
+
+    def find(self, image, mask=None):
+        """Finds the biggest blob of the colour.
+
+        Args:
+            image (cv2 image): BGR image to analyze
+            mask (cv2 image): mask from mask(image), if already made
+
+        Returns:
+            rect (tuple): (x, y, w, h) of the blob in image coordinates,
+                or None if there is none
+        """
+        if mask is None:
+            mask = self.mask(image)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if len(contours) == 0:
+            return None
+        c = max(contours, key=cv2.contourArea)
+        x, y, w, h = cv2.boundingRect(c)
+        s = 1.0 / self.scale
+        rect = (int(x * s), int(y * s), int(w * s), int(h * s))
+        if rect[2] * rect[3] < self.min_area:
+            return None
+        return rect
+
+    def __call__(self, image):
+        # Lets a ColorFinder be registered as a DroneB detector
+        return self.find(image)
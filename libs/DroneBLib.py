@@ -9,9 +9,12 @@ WASD - Drone Forward, Left, Right, Back
 Q/E - slow yaw
 Arrow keys - ascend, descend, or yaw
 H - toggle HUD
+M - HUD shows flight data / live metrics
+F - profile for 10 seconds (profile_<date>.folded)
 backspace - land
 P - palm-land
-Enter - take picture
+Enter - save a snapshot
+B - save a burst of snapshots
 R - toggle recording
 C - toggle command queue on/off
 X - toggle forward / downward cam
@@ -20,52 +23,1932 @@ Based on work from Hanyazou
 https://github.com/hanyazou/TelloPy
 ---------------------------------------
 '''
+import os
+import sys
+import math
 import time
-from datetime import datetime, timedelta
-import cv2
-import tellopy
+from datetime import datetime
+import importlib
 import av
 import numpy
-import pygame
-import pygame.display
-import pygame.key
-import pygame.locals
-import pygame.font
-import copy
-from threading import Event, Thread, Lock
-from collections import deque
+import threading
+from threading import Event, Thread, Lock, Condition, current_thread
+import multiprocessing
+import queue
+import heapq
+import itertools
+import weakref
+import bisect
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 #Python library that allows you to create multiple threads to run multiple functions at the same time
 
+class LazyModule(object):
+    '''
+    Stands in for a module that is slow to import and imports it the
+    first time one of its attributes is used, then takes its place in
+    this module.  The window needs pygame, drawing and some conversions
+    need cv2 and only a real drone needs tellopy, so a program that
+    doesn't use them starts without loading them.
+    '''
+    def __init__(self, name, as_name = None, submodules = ()):
+        self._name = name
+        self._as_name = as_name or name
+        self._submodules = submodules
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            for sub in self._submodules:
+                importlib.import_module(self._name + '.' + sub)
+            self._module = module
+            if globals().get(self._as_name) is self:
+                globals()[self._as_name] = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+cv2 = LazyModule('cv2')
+pygame = LazyModule('pygame', submodules=('display', 'key', 'locals', 'font'))
+tellopy = LazyModule('tellopy')
+shared_memory = LazyModule('multiprocessing.shared_memory', 'shared_memory')
+http_server = LazyModule('http.server', 'http_server') # only for start_metrics_server()
+
 # Thread-safe global objects
 class SafeFrame(object):
-    def __init__(self, startval = None):
+    '''
+    Hands frames from the grab thread to the main loop without copying
+    them for every reader.  Frames are written into a small ring of
+    preallocated numpy buffers and readers get a read-only view of the
+    newest slot along with its sequence number.
+
+    A view stays valid until the ring wraps around (slots - 1 newer
+    frames).  Call .copy() on it if you need to keep it longer.
+
+    Listeners are called with the new seq after every frame (and with
+    the last seq on close()), for waking up readers that can't block
+    in wait(), such as an asyncio loop.
+    '''
+    def __init__(self, startval = None, slots = 3):
         self.lock = Lock()
-        self.value = startval
-    def set(self, val):
-        self.lock.acquire(True, 0.1)
-        try:
-            self.value = val
-        finally:
-            self.lock.release()
+        self.cond = Condition(self.lock)
+        self.closed = False
+        self.listeners = []
+        self.lock_wait = None # Histogram of how long set() waits for the lock
+        self.slots = slots
+        self.buffers = None
+        self.index = -1
+        self.seq = 0
+        self.stamp = None
+        self.value = None
+        if startval is not None:
+            self.set(startval)
+
+    def _alloc(self, shape, dtype):
+        self.buffers = [numpy.empty(shape, dtype) for _ in range(self.slots)]
+        self.index = -1
+
+    def set(self, val, stamp = None):
+        ''' Copy val into the next ring slot and publish it '''
+        arr = numpy.asarray(val)
+        if self.buffers is None or self.buffers[0].shape != arr.shape or self.buffers[0].dtype != arr.dtype:
+            # Size changed (first frame or video mode switch)
+            with self.lock:
+                self._alloc(arr.shape, arr.dtype)
+        # Only the grab thread writes, and never into the slot
+        # readers are currently being handed, so no lock is needed here
+        index = (self.index + 1) % self.slots
+        buf = self.buffers[index]
+        numpy.copyto(buf, arr)
+        view = buf.view()
+        view.flags.writeable = False
+        t = time.perf_counter()
+        with self.lock:
+            if self.lock_wait is not None:
+                self.lock_wait.observe(time.perf_counter() - t)
+            self.index = index
+            self.seq += 1
+            self.stamp = time.monotonic() if stamp is None else stamp
+            self.value = view
+            self.cond.notify_all()
+            seq = self.seq
+        for listener in self.listeners:
+            listener(seq)
+
     def get(self):
-        self.lock.acquire()
-        try:
-            return copy.deepcopy(self.value)
-        finally:
-            self.lock.release()
+        ''' Returns a read-only view of the newest frame (or None) '''
+        with self.lock:
+            return self.value
+
+    def get_latest(self):
+        ''' Returns (frame, seq) for the newest frame.  seq is 0 until a frame arrives '''
+        with self.lock:
+            return self.value, self.seq
+
+    def wait(self, after_seq = 0, timeout = None):
+        '''
+        Blocks until a frame newer than after_seq is published.
+        Returns (frame, seq, stamp), or None on timeout or close()
+        '''
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > after_seq or self.closed, timeout)
+            if self.seq > after_seq:
+                return self.value, self.seq, self.stamp
+            return None
+
+    def add_listener(self, listener):
+        self.listeners = self.listeners + [listener] # replaced, never changed in place
+
+    def remove_listener(self, listener):
+        self.listeners = [l for l in self.listeners if l != listener]
+
+    def close(self):
+        ''' Wakes up everyone blocked in wait() for good '''
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            seq = self.seq
+        for listener in self.listeners:
+            listener(seq)
+
 class SafeExiting(object):
-    def __init__(self, startval = False):
+    '''
+    Exit signal for a group of threads.  With a parent, get() is also
+    True once the parent is set - each DroneB's signal has the process
+    wide exiting as parent, so setting that stops every drone.
+    '''
+    def __init__(self, startval = False, parent = None):
         self.lock = Lock()
         self.value = startval
+        self.parent = parent
     def set(self, exiting):
         with self.lock:
             self.value = exiting
     def get(self):
         with self.lock:
-            return self.value
+            value = self.value
+        if value == False and self.parent is not None:
+            return self.parent.get()
+        return value
 
-current_frame = SafeFrame()
+# Set once every started DroneB has quit (or to stop them all), and
+# cleared when a drone starts after that.  Each DroneB has its own
+# frames (db.current_frame) and exit signal (db.exiting).
 exiting = SafeExiting(False)
+drones = weakref.WeakSet() # every started DroneB in this process
+
+def register_drone(db):
+    ''' Counts db as started; the first one since every drone quit clears exiting '''
+    if all(d.exiting.value for d in drones):
+        exiting.set(False)
+    drones.add(db)
+
+# Formats frame_grab can publish.  'y' is the luma plane of the
+# decoded yuv420p frame and needs no conversion at all.
+FRAME_FORMATS = ('bgr24', 'gray', 'y', 'yuv420p')
+
+def frame_to_ndarray(frame, frame_format = 'bgr24'):
+    '''
+    Returns a numpy view of a decoded PyAV frame in frame_format,
+    converting (at most once) with swscale.  The view points into the
+    frame's own memory, so copy it (SafeFrame.set does) before keeping it.
+    '''
+    if frame_format == 'yuv420p':
+        # All three planes stacked, as cv2.COLOR_YUV2BGR_I420 expects
+        if frame.format.name != 'yuv420p':
+            frame = frame.reformat(format='yuv420p')
+        return frame.to_ndarray()
+    channels = 3 if frame_format == 'bgr24' else 1
+    if frame_format != 'y' and frame.format.name != frame_format:
+        frame = frame.reformat(format=frame_format)
+    plane = frame.planes[0]
+    width, height = frame.width, frame.height
+    rows = numpy.frombuffer(plane, numpy.uint8).reshape(-1, plane.line_size)
+    image = rows[:height, :width * channels]
+    if channels == 3:
+        image = image.reshape(height, width, 3)
+    return image
+
+def bgr_to_ndarray(image, frame_format = 'bgr24'):
+    ''' Converts an already decoded BGR image to frame_format '''
+    if frame_format == 'bgr24':
+        return image
+    if frame_format == 'yuv420p':
+        return cv2.cvtColor(image, cv2.COLOR_BGR2YUV_I420)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+class FramePacer(object):
+    '''
+    Sleeps so offline video plays back at its recorded speed.  With
+    realtime off, frames are published as fast as they can be decoded.
+    '''
+    def __init__(self, realtime = True, fps = 30):
+        self.realtime = realtime
+        self.fps = fps
+        self.reset()
+
+    def reset(self):
+        self.start = None
+        self.count = 0
+
+    def wait(self, t = None):
+        '''
+        Waits until video time t (in seconds) is due.  Returns how many
+        seconds late it already was (0 when not realtime).
+        '''
+        if t is None:
+            t = self.count / self.fps
+        self.count += 1
+        if not self.realtime:
+            return 0
+        now = time.monotonic()
+        if self.start is None:
+            self.start = now - t
+        delay = self.start + t - now
+        if delay > 0:
+            time.sleep(delay)
+            return 0
+        return -delay
+
+    def skip(self):
+        ''' Counts a frame that was never decoded, so frames without a time stay on schedule '''
+        self.count += 1
+
+FRAME_POLICIES = ('smooth', 'latest', 'keyframes', 'fps')
+
+class FramePolicy(object):
+    '''
+    Decides which frames frame_grab decodes and publishes, trading
+    smoothness for latency:
+
+      smooth    - every frame is decoded and published, late or not
+      latest    - frames that are already late (a newer one is waiting)
+                  are decoded but not converted or published.  If the
+                  decoder falls catchup frames behind it skips ahead to
+                  the next keyframe, so the delay can't build up
+      keyframes - only keyframes are decoded and published
+      fps       - at most fps frames a second are published
+
+    Counters: decoded, published, dropped (not published, including
+    packets never decoded) and stale (already late when decoded).
+    '''
+    def __init__(self, mode = 'smooth', fps = None, catchup = 15):
+        if mode not in FRAME_POLICIES:
+            raise ValueError("frame policy must be one of {}".format(FRAME_POLICIES))
+        if mode == 'fps' and not fps:
+            raise ValueError("the fps frame policy needs a target fps")
+        self.mode = mode
+        self.fps = fps
+        self.catchup = catchup
+        self.skipping = False # waiting for a keyframe to catch up
+        self.next_publish = 0
+        self.frame_bytes = None # average packet size, to turn a backlog into frames
+        self.decoded = 0
+        self.published = 0
+        self.dropped = 0
+        self.stale = 0
+
+    @staticmethod
+    def parse(text):
+        ''' Makes a policy from 'latest', 'fps:10' and so on ($DRONEB_FRAME_POLICY) '''
+        mode, _, fps = text.partition(':')
+        return FramePolicy(mode, float(fps) if fps else None)
+
+    def behind(self, late, backlog, fps):
+        '''
+        Returns how many frames behind the video is, from how late the
+        pacer found the frame (seconds) and the bytes still waiting to
+        be decoded.
+        '''
+        frames = late * fps
+        if backlog and self.frame_bytes:
+            frames = max(frames, backlog / self.frame_bytes)
+        return frames
+
+    def want_packet(self, packet, behind):
+        ''' Whether to decode a demuxed packet at all '''
+        if packet.size == 0:
+            return True # flush packet
+        size = float(packet.size)
+        self.frame_bytes = size if self.frame_bytes is None else self.frame_bytes * 0.95 + size * 0.05
+        if self.mode == 'keyframes' and not packet.is_keyframe:
+            self.dropped += 1
+            return False
+        if self.mode == 'latest':
+            if behind >= self.catchup and not packet.is_keyframe:
+                self.skipping = True
+            if self.skipping:
+                if not packet.is_keyframe:
+                    self.dropped += 1
+                    self.stale += 1
+                    return False
+                self.skipping = False
+        return True
+
+    def want_frame(self, behind, now = None):
+        ''' Whether to publish a decoded frame '''
+        self.decoded += 1
+        late = behind >= 1
+        if late:
+            self.stale += 1
+        publish = True
+        if self.mode == 'latest':
+            publish = not late
+        elif self.mode == 'fps':
+            if now is None:
+                now = time.monotonic()
+            publish = now >= self.next_publish
+            if publish:
+                # Keep to the schedule, but don't save up frames after a pause
+                interval = 1.0 / self.fps
+                if self.next_publish < now - interval:
+                    self.next_publish = now
+                self.next_publish += interval
+        if publish:
+            self.published += 1
+        else:
+            self.dropped += 1
+        return publish
+
+    def stats(self):
+        return {'mode': self.mode, 'decoded': self.decoded, 'published': self.published,
+                'dropped': self.dropped, 'stale': self.stale}
+
+class SyntheticVideo(object):
+    '''
+    Generates BGR test frames - a blue square drifting around a grey
+    background (inside the colour range DBTrack looks for).
+    count = None generates frames forever.
+    '''
+    def __init__(self, width = 960, height = 720, count = None, size = 120):
+        self.width = width
+        self.height = height
+        self.count = count
+        self.size = size
+
+    def frames(self):
+        image = numpy.full((self.height, self.width, 3), 128, numpy.uint8)
+        n = 0
+        while self.count is None or n < self.count:
+            x = int((self.width - self.size) / 2 * (1 + math.sin(n / 40)))
+            y = int((self.height - self.size) / 2 * (1 + math.sin(n / 55)))
+            image[y:y + self.size, x:x + self.size] = (110, 50, 30)
+            yield image
+            # Erase the square again (the frame gets copied by SafeFrame)
+            image[y:y + self.size, x:x + self.size] = 128
+            n += 1
+
+class StubSocket(object):
+    ''' Swallows raw commands (like downvision) sent to a StubTello '''
+    def __init__(self, drone):
+        self.drone = drone
+    def sendto(self, data, addr):
+        self.drone.command('sendto', data.decode('utf-8'))
+
+class StubTello(object):
+    '''
+    Stands in for tellopy.Tello when flying without a drone.  It accepts
+    the same calls DroneB makes and remembers the latest ones in
+    .commands as (time.monotonic(), name, value) tuples.
+    '''
+    EVENT_FLIGHT_DATA = 'flight_data' # subscribe() ignores it anyway
+
+    def __init__(self):
+        self.commands = deque(maxlen=1000)
+        self.sock = StubSocket(self)
+        self.tello_addr = ('192.168.10.1', 8889)
+        self.fast_mode = False
+
+    def command(self, name, value = None):
+        self.commands.append((time.monotonic(), name, value))
+
+    # Connection and video
+    def connect(self):
+        pass
+    def wait_for_connection(self, timeout = None):
+        pass
+    def start_video(self):
+        pass
+    def subscribe(self, signal, handler):
+        pass
+    def quit(self):
+        self.command('quit')
+    def set_video_mode(self, zoom = False):
+        self.command('set_video_mode', zoom)
+    def set_exposure(self, level):
+        self.command('set_exposure', level)
+    def set_video_encoder_rate(self, rate):
+        self.command('set_video_encoder_rate', rate)
+
+    # Flight
+    def takeoff(self):
+        self.command('takeoff')
+    def land(self):
+        self.command('land')
+    def palm_land(self):
+        self.command('palm_land')
+    def take_picture(self):
+        self.command('take_picture')
+    def forward(self, val):
+        self.command('forward', val)
+    def backward(self, val):
+        self.command('backward', val)
+    def left(self, val):
+        self.command('left', val)
+    def right(self, val):
+        self.command('right', val)
+    def up(self, val):
+        self.command('up', val)
+    def down(self, val):
+        self.command('down', val)
+    def clockwise(self, val):
+        self.command('clockwise', val)
+    def counter_clockwise(self, val):
+        self.command('counter_clockwise', val)
+    def throw_and_go(self):
+        self.command('throw_and_go')
+    def manual_takeoff(self):
+        self.command('manual_takeoff')
+    def emergency(self):
+        self.command('emergency')
+    def toggle_fast_mode(self):
+        self.fast_mode = not self.fast_mode
+        self.command('toggle_fast_mode', self.fast_mode)
+
+    # Sticks (-1.0 to 1.0)
+    def set_throttle(self, throttle):
+        self.command('set_throttle', throttle)
+    def set_yaw(self, yaw):
+        self.command('set_yaw', yaw)
+    def set_pitch(self, pitch):
+        self.command('set_pitch', pitch)
+    def set_roll(self, roll):
+        self.command('set_roll', roll)
+
+    # Moves by a distance (cm) or angle (degrees)
+    def up_absolute(self, cm):
+        self.command('up_absolute', cm)
+    def down_absolute(self, cm):
+        self.command('down_absolute', cm)
+    def forward_absolute(self, cm):
+        self.command('forward_absolute', cm)
+    def backward_absolute(self, cm):
+        self.command('backward_absolute', cm)
+    def left_absolute(self, cm):
+        self.command('left_absolute', cm)
+    def right_absolute(self, cm):
+        self.command('right_absolute', cm)
+    def clockwise_absolute(self, degrees):
+        self.command('clockwise_absolute', degrees)
+    def counter_clockwise_absolute(self, degrees):
+        self.command('counter_clockwise_absolute', degrees)
+
+    # Flips
+    def flip_forward(self):
+        self.command('flip_forward')
+    def flip_back(self):
+        self.command('flip_back')
+    def flip_left(self):
+        self.command('flip_left')
+    def flip_right(self):
+        self.command('flip_right')
+    def flip_forwardleft(self):
+        self.command('flip_forwardleft')
+    def flip_backleft(self):
+        self.command('flip_backleft')
+    def flip_forwardright(self):
+        self.command('flip_forwardright')
+    def flip_backright(self):
+        self.command('flip_backright')
+
+TelloB = None # made by make_tello(), so tellopy is only imported for a real drone
+
+def make_tello(port = 9000, video_port = 6038):
+    '''
+    Makes a tellopy.Tello that asks its drone to send the video to
+    video_port.  tellopy itself always asks for 6038, whatever port it
+    listens on, so a second drone's video would go to the first one.
+    '''
+    global TelloB
+    if TelloB is None:
+        class TelloB(tellopy.Tello):
+            def _Tello__send_conn_req(self):
+                # 'conn_req:' and the video port, little endian
+                port = self._Tello__video_port
+                buf = b'conn_req:' + bytes([port & 0xff, (port >> 8) & 0xff])
+                return self.send_packet(tellopy._internal.protocol.Packet(buf))
+    return TelloB(port=port, video_port=video_port)
+
+class Telemetry(object):
+    ''' One flight data sample from the drone, stamped with time.monotonic() '''
+    __slots__ = ('stamp', 'height', 'north_speed', 'east_speed', 'ground_speed',
+                 'battery', 'wifi', 'camera', 'fly_mode', 'fly_time')
+
+    def __init__(self, stamp, data):
+        self.stamp = stamp
+        self.height = data.height
+        self.north_speed = data.north_speed
+        self.east_speed = data.east_speed
+        self.ground_speed = data.ground_speed
+        self.battery = data.battery_percentage
+        self.wifi = data.wifi_strength
+        self.camera = data.camera_state
+        self.fly_mode = data.fly_mode
+        self.fly_time = data.fly_time
+
+class TelemetryBuffer(object):
+    '''
+    Keeps the most recent telemetry samples in a fixed-size ring with
+    one numpy column per field, so control code can look at e.g. the
+    last second of velocities without any parsing.
+    Subscribers are called with every new Telemetry sample (on the
+    drone's event thread, so keep them short).
+    '''
+    DTYPES = {'stamp': numpy.float64, 'fly_time': numpy.int32}
+
+    def __init__(self, size = 1024):
+        self.lock = Lock()
+        self.size = size
+        self.count = 0 # samples ever added
+        self.columns = dict((field, numpy.zeros(size, self.DTYPES.get(field, numpy.int16)))
+                            for field in Telemetry.__slots__)
+        self.subscribers = []
+
+    def append(self, sample):
+        with self.lock:
+            i = self.count % self.size
+            for field, column in self.columns.items():
+                column[i] = getattr(sample, field)
+            self.count += 1
+        for callback in self.subscribers:
+            callback(sample)
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def _indexes(self, n):
+        # Ring positions of the last n samples, oldest first
+        n = min(n, self.count, self.size)
+        return numpy.arange(self.count - n, self.count) % self.size
+
+    def recent(self, field, n = None):
+        ''' Returns a copy of the last n values of field, oldest first '''
+        with self.lock:
+            return self.columns[field][self._indexes(self.size if n is None else n)]
+
+    def since(self, stamp):
+        ''' Returns {field: values} for every sample newer than stamp '''
+        with self.lock:
+            idx = self._indexes(self.size)
+            idx = idx[self.columns['stamp'][idx] > stamp]
+            return dict((field, column[idx]) for field, column in self.columns.items())
+
+class Counter(object):
+    '''
+    A count that only goes up.  inc() is one attribute update, so it's
+    fine on hot paths (each counter should be updated from one thread).
+    With func the value is read from func() when scraped instead.
+    '''
+    kind = 'counter'
+    __slots__ = ('name', 'help', 'value', 'func')
+
+    def __init__(self, name, help, func = None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.func = func
+
+    def inc(self, n = 1):
+        self.value += n
+
+    def get(self):
+        return self.func() if self.func is not None else self.value
+
+class Gauge(Counter):
+    ''' A value that goes up and down (set() it, or give a func) '''
+    kind = 'gauge'
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+class Histogram(object):
+    '''
+    Counts observations into fixed buckets (upper bounds, in seconds by
+    default), plus their sum and count.  observe() is a bisect and a
+    few additions under a lock, as a histogram can be fed from several
+    threads (e.g. stage hooks).
+    '''
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum', 'count', 'lock')
+
+    def __init__(self, name, help, buckets = None):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) if buckets is not None else self.DEFAULT_BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def get(self):
+        with self.lock:
+            return (self.count, self.sum)
+
+    def snapshot(self):
+        ''' (bucket counts, sum, count), all from the same moment '''
+        with self.lock:
+            return (list(self.counts), self.sum, self.count)
+
+class Metrics(object):
+    '''
+    Registry of a drone's counters, gauges and histograms.  Every metric
+    is labelled with labels (e.g. {'drone': 'tello1'}) so the registries
+    of several drones can be served together.  render_metrics() gives
+    the Prometheus text format and start_metrics_server() serves it.
+    '''
+    def __init__(self, labels = None, prefix = 'droneb_'):
+        self.labels = dict(labels or {})
+        self.prefix = prefix
+        self.metrics = OrderedDict() # name => metric
+
+    def add(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, func = None):
+        return self.add(Counter(name, help, func))
+
+    def gauge(self, name, help, func = None):
+        return self.add(Gauge(name, help, func))
+
+    def histogram(self, name, help, buckets = None):
+        return self.add(Histogram(name, help, buckets))
+
+    def get(self, name):
+        return self.metrics.get(self.prefix + name)
+
+def format_labels(labels, extra = None):
+    items = list(labels.items()) + (extra or [])
+    if len(items) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in items) + '}'
+
+def render_metrics(registries):
+    ''' Returns the metrics of one or more registries in the Prometheus text format '''
+    if isinstance(registries, Metrics):
+        registries = [registries]
+    names = OrderedDict()
+    for registry in registries:
+        for name, metric in registry.metrics.items():
+            names.setdefault(name, []).append((registry, metric))
+    lines = []
+    for name, entries in names.items():
+        first = entries[0][1]
+        lines.append('# HELP {} {}'.format(name, first.help))
+        lines.append('# TYPE {} {}'.format(name, first.kind))
+        for registry, metric in entries:
+            if metric.kind == 'histogram':
+                counts, total_sum, count = metric.snapshot()
+                total = 0
+                bounds = [repr(float(b)) for b in metric.buckets] + ['+Inf']
+                for bound, n in zip(bounds, counts):
+                    total += n
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(registry.labels, [('le', bound)]), total))
+                lines.append('{}_sum{} {}'.format(name, format_labels(registry.labels), total_sum))
+                lines.append('{}_count{} {}'.format(name, format_labels(registry.labels), count))
+            else:
+                try:
+                    value = metric.get()
+                except Exception:
+                    continue # e.g. a func whose object is gone
+                if value is None:
+                    continue
+                lines.append('{}{} {}'.format(name, format_labels(registry.labels), value))
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(object):
+    # Mixed into http.server.BaseHTTPRequestHandler by start_metrics_server()
+    registries = []
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render_metrics(self.registries).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # no line per scrape
+
+def start_metrics_server(registries, port = 9100, host = '127.0.0.1'):
+    '''
+    Serves the metrics of one or more registries (or DroneBs) at
+    http://host:port/metrics from a background thread.  Only localhost
+    by default.  Returns the server; call .shutdown() to stop it.
+    '''
+    if not isinstance(registries, (list, tuple)):
+        registries = [registries]
+    registries = [getattr(r, 'metrics', r) for r in registries]
+    handler = type('DroneBMetricsHandler', (MetricsHandler, http_server.BaseHTTPRequestHandler),
+                   {'registries': registries})
+    server = http_server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+STAGES = ('decode', 'convert', 'display', 'hud', 'command_queue', 'vision')
+
+class StageHooks(object):
+    '''
+    Named hook points around the work done for every frame.  Code
+    brackets a stage with start = time.perf_counter() ... done(stage,
+    start), or "with hooks.timed(stage):", and every callback added for
+    that stage is called with (stage, seconds) on the thread that did
+    the work.  Callbacks should be quick - they run in the video path.
+    '''
+    def __init__(self):
+        self.hooks = {} # stage => tuple of callbacks, replaced (not changed) by add/remove
+
+    def add(self, stage, callback):
+        self.hooks[stage] = self.hooks.get(stage, ()) + (callback,)
+
+    def remove(self, stage, callback):
+        self.hooks[stage] = tuple(c for c in self.hooks.get(stage, ()) if c != callback)
+
+    def done(self, stage, start):
+        ''' Reports a stage that started at start (time.perf_counter()), returns its seconds '''
+        seconds = time.perf_counter() - start
+        for callback in self.hooks.get(stage, ()):
+            callback(stage, seconds)
+        return seconds
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.done(stage, start)
+
+class StackSampler(object):
+    '''
+    Sampling profiler: every interval seconds, for duration seconds,
+    records the Python stack of every other thread.  The counts are
+    written to path as collapsed stacks (thread;outer;...;inner count),
+    ready for flamegraph.pl or speedscope.  Runs on its own thread, so
+    it can be started and stopped in the middle of a flight.
+    '''
+    def __init__(self, path, duration = 10, interval = 0.01, exit_flag = None):
+        self.path = path
+        self.duration = duration
+        self.interval = interval
+        self.exit_flag = exit_flag if exit_flag is not None else exiting
+        self.stacks = {} # collapsed stack => samples
+        self.samples = 0
+        self.names = {} # code object => 'function (file:line)'
+        self.running = True
+        self.thread = Thread(target=self.sample_loop, daemon=True)
+        self.thread.start()
+
+    def frame_name(self, code):
+        name = self.names.get(code)
+        if name is None:
+            name = '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+            self.names[code] = name
+        return name
+
+    def sample(self):
+        me = current_thread().ident
+        threads = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(threads.get(ident, 'thread-{}'.format(ident)))
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def sample_loop(self):
+        end = time.monotonic() + self.duration
+        next_time = time.monotonic()
+        while self.running and self.exit_flag.get() == False and time.monotonic() < end:
+            self.sample()
+            next_time += self.interval
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.monotonic()
+        self.write()
+        self.running = False
+
+    def write(self):
+        with open(self.path, 'w') as f:
+            for key, count in sorted(self.stacks.items()):
+                f.write('{} {}\n'.format(key, count))
+        print("Profile saved to {} ({} samples)".format(self.path, self.samples))
+
+    def stop(self):
+        ''' Stops early (the profile is still written) and waits for it '''
+        self.running = False
+        self.thread.join()
+
+# Fixed-size record of a flight log.  kind 0 is a telemetry sample,
+# kind 1 a command sent to the drone (name and value).
+LOG_MAGIC = b'DRONEBLG'
+LOG_HEADER = 64 # magic, version, record size, record count, padding
+LOG_DTYPE = numpy.dtype([('stamp', '<f8'), ('kind', 'u1'), ('name', 'S15'), ('value', '<f4'),
+                         ('height', '<i2'), ('north_speed', '<i2'), ('east_speed', '<i2'),
+                         ('ground_speed', '<i2'), ('battery', '<i2'), ('wifi', '<i2'),
+                         ('camera', '<i2'), ('fly_mode', '<i2'), ('fly_time', '<i4')])
+LOG_TELEMETRY = 0
+LOG_COMMAND = 1
+
+class FlightRecorder(object):
+    '''
+    Records every telemetry sample and command to a binary log of
+    fixed-size LOG_DTYPE records.  Logging only appends a tuple to a
+    queue; a background thread writes them in bulk into the memory
+    mapped file every flush_interval seconds, so the drone's event
+    thread never waits on the disk.  Read logs back with read_flight_log().
+    '''
+    def __init__(self, path, flush_interval = 0.5, capacity = 65536, exit_flag = None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.exit_flag = exit_flag if exit_flag is not None else exiting
+        self.pending = deque()
+        self.count = 0
+        self.running = True
+        self.file = open(path, 'w+b')
+        self.capacity = 0
+        self.records = None
+        self._grow(capacity)
+        self.thread = Thread(target=self.flush_loop)
+        self.thread.start()
+
+    def _grow(self, capacity):
+        # Make the file bigger and map it again
+        if self.records is not None:
+            self.records.flush()
+            del self.records
+        self.file.truncate(LOG_HEADER + capacity * LOG_DTYPE.itemsize)
+        self.capacity = capacity
+        self.records = numpy.memmap(self.file, LOG_DTYPE, 'r+', LOG_HEADER, (capacity,))
+
+    def _write_header(self):
+        header = numpy.memmap(self.file, numpy.uint8, 'r+', 0, (LOG_HEADER,))
+        header[:8] = numpy.frombuffer(LOG_MAGIC, numpy.uint8)
+        header[8:24] = numpy.array([1, LOG_DTYPE.itemsize, self.count, 0], '<u4').view(numpy.uint8)
+        header.flush()
+
+    def log_telemetry(self, sample):
+        self.pending.append((sample.stamp, LOG_TELEMETRY, b'', 0.0, sample.height, sample.north_speed,
+                             sample.east_speed, sample.ground_speed, sample.battery, sample.wifi,
+                             sample.camera, sample.fly_mode, sample.fly_time))
+
+    def log_command(self, name, value = None):
+        self.pending.append((time.monotonic(), LOG_COMMAND, name.encode('utf-8')[:15],
+                             0.0 if value is None else float(value), 0, 0, 0, 0, 0, 0, 0, 0, 0))
+
+    def flush(self):
+        ''' Writes everything queued so far to the log '''
+        n = len(self.pending)
+        if n == 0:
+            return
+        rows = [self.pending.popleft() for _ in range(n)]
+        if self.count + n > self.capacity:
+            self._grow(max(self.capacity * 2, self.count + n))
+        self.records[self.count:self.count + n] = numpy.array(rows, LOG_DTYPE)
+        self.count += n
+        self.records.flush()
+        self._write_header()
+
+    def flush_loop(self):
+        while self.running and self.exit_flag.get() == False:
+            time.sleep(self.flush_interval)
+            self.flush()
+        # The header always holds the count, so the log is readable
+        # even if close() is never called
+        self.flush()
+
+    def close(self):
+        ''' Writes what's left and trims the file to the records written '''
+        self.running = False
+        if current_thread() is not self.thread:
+            self.thread.join()
+        self.flush()
+        self.records.flush()
+        del self.records
+        self.records = None
+        self.file.truncate(LOG_HEADER + self.count * LOG_DTYPE.itemsize)
+        self.file.close()
+
+def read_flight_log(path):
+    '''
+    Returns the records of a flight log as a (memory mapped) numpy
+    array of LOG_DTYPE.  Telemetry is log[log['kind'] == LOG_TELEMETRY],
+    commands are log[log['kind'] == LOG_COMMAND].
+    '''
+    header = numpy.fromfile(path, numpy.uint8, LOG_HEADER)
+    if header[:8].tobytes() != LOG_MAGIC:
+        raise ValueError("{} is not a DroneB flight log".format(path))
+    version, size, count = header[8:20].view('<u4')
+    if size != LOG_DTYPE.itemsize:
+        raise ValueError("{} uses an unknown record size ({})".format(path, size))
+    if count == 0:
+        return numpy.zeros(0, LOG_DTYPE)
+    return numpy.memmap(path, LOG_DTYPE, 'r', LOG_HEADER, (int(count),))
+
+class RecordedDrone(object):
+    '''
+    Wraps the tellopy drone so every command sent through it is also
+    logged to a FlightRecorder.  Everything else is passed through.
+    '''
+    COMMANDS = ('takeoff', 'land', 'palm_land', 'take_picture', 'set_video_mode',
+                'forward', 'backward', 'left', 'right', 'up', 'down',
+                'clockwise', 'counter_clockwise', 'flip_forward', 'flip_back',
+                'flip_left', 'flip_right')
+
+    def __init__(self, drone, recorder):
+        self.drone = drone
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        attr = getattr(self.drone, name)
+        if name not in self.COMMANDS:
+            return attr
+        def command(*args):
+            self.recorder.log_command(name, args[0] if len(args) > 0 else None)
+            return attr(*args)
+        return command
+
+class VideoRecorder(object):
+    '''
+    Records the drone's video by remuxing the H.264 packets frame_grab
+    already demuxes into an MP4/MKV file - nothing is decoded or
+    re-encoded.  put() never blocks the grab thread: packets go on a
+    bounded queue and a background thread writes them.  If the queue
+    overflows, packets are dropped until the next keyframe so the file
+    stays decodable.
+    '''
+    def __init__(self, path, template, max_queue = 256, exit_flag = None, format = None, options = None):
+        self.path = path
+        self.exit_flag = exit_flag if exit_flag is not None else exiting
+        self.output = av.open(path, 'w', format=format, options=options or {})
+        if hasattr(self.output, 'add_stream_from_template'):
+            self.stream = self.output.add_stream_from_template(template)
+        else:
+            self.stream = self.output.add_stream(template=template)
+        self.packets = queue.Queue(max_queue)
+        self.need_keyframe = True # files must start on a keyframe
+        self.written = 0
+        self.dropped = 0
+        self.start = None
+        self.thread = Thread(target=self.write_loop)
+        self.thread.start()
+
+    def put(self, packet):
+        ''' Queues a demuxed packet (called by the grab thread) '''
+        if packet.size == 0:
+            return
+        if self.need_keyframe:
+            if not packet.is_keyframe:
+                self.dropped += 1
+                return
+            self.need_keyframe = False
+        # frame_grab is about to decode this packet and the writer thread
+        # retimes what it's given, so it gets its own copy
+        copy = av.Packet(bytes(packet))
+        copy.pts = packet.pts
+        copy.dts = packet.dts
+        copy.time_base = packet.time_base
+        copy.is_keyframe = packet.is_keyframe
+        try:
+            self.packets.put_nowait((copy, time.monotonic()))
+        except queue.Full:
+            self.dropped += 1
+            self.need_keyframe = True
+
+    def write_loop(self):
+        while True:
+            try:
+                item = self.packets.get(timeout=0.5)
+            except queue.Empty:
+                if self.exit_flag.get() == True:
+                    break # everything is written and the program is ending
+                continue
+            if item is None:
+                break
+            packet, stamp = item
+            if packet.pts is None:
+                # Raw drone stream - time the packets by when they arrived
+                if self.start is None:
+                    self.start = stamp
+                packet.pts = packet.dts = int((stamp - self.start) / self.stream.time_base)
+                packet.time_base = self.stream.time_base
+            packet.stream = self.stream
+            try:
+                self.output.mux(packet)
+                self.written += 1
+            except Exception as e:
+                print("ERROR recording: {}".format(e))
+        self.output.close()
+
+    def close(self):
+        ''' Writes the queued packets and closes the file '''
+        self.packets.put(None)
+        self.thread.join()
+
+def ndarray_to_bgr(image, frame_format, rotate = False):
+    ''' Returns a frame from the ring (any FRAME_FORMATS) as a BGR image '''
+    if frame_format == 'yuv420p':
+        image = cv2.cvtColor(image, cv2.COLOR_YUV2BGR_I420)
+    elif image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if rotate:
+        image = cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+    return image
+
+class SnapshotWriter(object):
+    '''
+    Saves video frames as JPEG or PNG files without holding up the
+    video loop.  The caller only copies the frame out of the ring;
+    colour conversion, encoding and the disk write run on a small
+    thread pool (cv2 releases the GIL while it encodes).  burst()
+    saves the next N frames from a thread of its own.  If the pool
+    falls too far behind, frames are skipped rather than piling up.
+    '''
+    def __init__(self, folder = '.', fmt = 'jpg', quality = 95, workers = 2, max_pending = 32,
+                 prefix = 'snapshot', exit_flag = None):
+        self.folder = folder
+        self.fmt = fmt
+        self.prefix = prefix
+        self.exit_flag = exit_flag if exit_flag is not None else exiting
+        self.params = []
+        if fmt in ('jpg', 'jpeg'):
+            self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        elif fmt == 'png':
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, 1] # fast, files are a bit bigger
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='snapshot')
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = Lock()
+        self.saved = 0
+        self.skipped = 0
+        self.burst_thread = None
+
+    def save(self, frame, seq, frame_format, rotate = False, prefix = None):
+        '''
+        Queues one frame for saving and returns a Future for its path,
+        or None if it was skipped.  The frame is copied, so ring views
+        can be passed straight in.
+        '''
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.skipped += 1
+                return None
+            self.pending += 1
+        if prefix is None:
+            prefix = self.prefix
+        path = os.path.join(self.folder, '{}-{}-{:06d}.{}'.format(
+            prefix, datetime.now().strftime('%Y-%m-%d_%H%M%S'), seq, self.fmt))
+        return self.pool.submit(self.write, numpy.array(frame), path, frame_format, rotate)
+
+    def write(self, image, path, frame_format, rotate):
+        try:
+            image = ndarray_to_bgr(image, frame_format, rotate)
+            ok, data = cv2.imencode('.' + self.fmt, image, self.params)
+            if not ok:
+                raise ValueError("could not encode " + path)
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.saved += 1
+            return path
+        except Exception as e:
+            print("ERROR saving snapshot: {}".format(e))
+            return None
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def burst(self, frames, count, frame_format, rotate = False, after_seq = 0):
+        '''
+        Saves the next count frames of a SafeFrame from a background
+        thread.  Returns False if a burst is already running.
+        '''
+        if self.burst_thread is not None and self.burst_thread.is_alive():
+            return False
+        self.burst_thread = Thread(target=self.burst_loop,
+            args=(frames, count, frame_format, rotate, after_seq), daemon=True)
+        self.burst_thread.start()
+        return True
+
+    def burst_loop(self, frames, count, frame_format, rotate, seq):
+        taken = 0
+        while taken < count and self.exit_flag.get() == False:
+            new_frame = frames.wait(seq, 0.5)
+            if new_frame is None:
+                continue
+            frame, seq, stamp = new_frame
+            self.save(frame, seq, frame_format, rotate, self.prefix.replace('snapshot', 'burst'))
+            taken += 1
+
+    def close(self):
+        ''' Waits for the queued snapshots to be written '''
+        self.pool.shutdown(wait=True)
+
+def restream_target(url):
+    '''
+    Returns (url, container format) for a restream target: MPEG-TS over
+    UDP (udp://host:port) or over RTP (rtp://host:port).  UDP packets are
+    kept to 7 TS packets so they never get fragmented.
+    '''
+    if url.startswith('rtp://'):
+        return url, 'rtp_mpegts'
+    if url.startswith('udp://') and 'pkt_size' not in url:
+        url += ('&' if '?' in url else '?') + 'pkt_size=1316'
+    return url, 'mpegts'
+
+class Restreamer(VideoRecorder):
+    '''
+    Forwards the drone's H.264 packets untouched as MPEG-TS to a UDP or
+    RTP target, e.g. for
+
+        ffplay -fflags nobuffer -flags low_delay udp://127.0.0.1:23000
+
+    Nothing is decoded or encoded, so it costs next to no CPU and adds
+    no latency of its own.  As with VideoRecorder put() never blocks the
+    grab thread; the queue is kept short so a stalled network drops
+    packets (up to the next keyframe) instead of building up delay.
+    '''
+    def __init__(self, url, template, max_queue = 30, exit_flag = None):
+        url, fmt = restream_target(url)
+        VideoRecorder.__init__(self, url, template, max_queue, exit_flag, fmt, {'flush_packets': '1'})
+
+class FrameStreamer(object):
+    '''
+    Encodes images in-process with PyAV and streams them as MPEG-TS to a
+    UDP or RTP target - for streaming frames with detections drawn on
+    them, where the drone's own packets won't do.
+
+    put() never blocks: at most max_queue images wait for the encoder
+    thread and when it can't keep up the oldest waiting image is dropped
+    (counted in .dropped), so the stream stays live rather than falling
+    behind.  Encoding releases the GIL.
+    '''
+    def __init__(self, url, width, height, fps = 30, codec = 'libx264', bit_rate = 2000000,
+                 max_queue = 2, exit_flag = None):
+        self.exit_flag = exit_flag if exit_flag is not None else exiting
+        url, fmt = restream_target(url)
+        self.path = url
+        self.size = (width, height)
+        self.fps = fps
+        self.output = av.open(url, 'w', format=fmt, options={'flush_packets': '1'})
+        self.stream = self.output.add_stream(codec, rate=fps)
+        self.stream.width = width
+        self.stream.height = height
+        self.stream.pix_fmt = 'yuv420p'
+        self.stream.bit_rate = bit_rate
+        self.stream.codec_context.gop_size = fps # a keyframe a second for late joiners
+        if codec == 'libx264':
+            self.stream.codec_context.options = {'preset': 'ultrafast', 'tune': 'zerolatency'}
+        self.max_queue = max_queue
+        self.images = deque()
+        self.cond = Condition()
+        self.closing = False
+        self.start = None
+        self.last_pts = -1
+        self.written = 0
+        self.dropped = 0
+        self.thread = Thread(target=self.write_loop)
+        self.thread.start()
+
+    def put(self, image, stamp = None):
+        ''' Queues a BGR (or gray) image, scaled to the stream's size '''
+        if stamp is None:
+            stamp = time.monotonic()
+        if image.shape[1::-1] != self.size:
+            image = cv2.resize(image, self.size, interpolation=cv2.INTER_LINEAR)
+        else:
+            image = numpy.array(image) # the caller may reuse it
+        with self.cond:
+            self.images.append((image, stamp))
+            if len(self.images) > self.max_queue:
+                self.images.popleft()
+                self.dropped += 1
+            self.cond.notify()
+
+    def write_loop(self):
+        while True:
+            with self.cond:
+                while len(self.images) == 0 and not self.closing and self.exit_flag.get() == False:
+                    self.cond.wait(0.5)
+                if len(self.images) == 0:
+                    break
+                image, stamp = self.images.popleft()
+            if self.start is None:
+                self.start = stamp
+            # Time frames by when they came in, never going backwards
+            pts = max(self.last_pts + 1, int(round((stamp - self.start) * self.fps)))
+            self.last_pts = pts
+            frame = av.VideoFrame.from_ndarray(image, format='bgr24' if image.ndim == 3 else 'gray')
+            frame.pts = pts
+            try:
+                for packet in self.stream.encode(frame):
+                    self.output.mux(packet)
+                self.written += 1
+            except Exception as e:
+                print("ERROR streaming: {}".format(e))
+        try:
+            for packet in self.stream.encode():
+                self.output.mux(packet)
+        except Exception as e:
+            print("ERROR streaming: {}".format(e))
+        self.output.close()
+
+    def close(self):
+        ''' Sends what's queued and stops '''
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join()
+
+def vision_worker(shm_name, slot_bytes, detectors, tasks, results):
+    '''
+    Runs in a VisionPool worker process.  Frames are read straight out
+    of shared memory, so only the small task tuples get pickled.
+    '''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            name, slot, seq, stamp, shape, dtype = task
+            image = numpy.ndarray(shape, dtype, buffer=shm.buf, offset=slot * slot_bytes)
+            image.flags.writeable = False
+            try:
+                result = detectors[name](image)
+            except Exception as e:
+                print("ERROR in detector {}: {}".format(name, e))
+                result = None
+            del image # release shm.buf before the next frame or close()
+            results.put((name, slot, seq, stamp, result))
+    finally:
+        shm.close()
+
+class VisionPool(object):
+    '''
+    Runs registered detectors in separate processes so vision scales
+    across cores instead of sharing the GIL with the main loop.  One
+    pool (sized to the cores) serves any number of drones.
+
+    Each drone gets its own ring of slots in shared memory.  Each new
+    frame is copied once into a free slot and every detector of that
+    drone gets a (slot, seq) task.  A slot is reused only when all
+    detectors are done with it; if every slot is busy the frame is
+    skipped (counted in .dropped) rather than queued, so results never
+    fall behind the video.  Results come back asynchronously, tagged
+    with the frame's seq and stamp.
+
+    Every detector always runs in the same worker, so one that keeps
+    state between frames (like QRReader's cache) sees all its frames,
+    in order.  The pool starts no more workers than there are detectors.
+
+    Detectors must be picklable (module level functions) because the
+    workers are started with 'spawn'.
+    '''
+    def __init__(self, drones, workers = None, slots = 4, slot_bytes = 1280 * 720 * 3):
+        if workers is None:
+            workers = max(1, (os.cpu_count() or 2) - 1)
+        self.drones = list(drones)
+        # Detectors and callbacks are keyed by (drone index, name)
+        self.detectors = {}
+        self.callbacks = {}
+        for i, db in enumerate(self.drones):
+            for name, detector in db.detectors.items():
+                self.detectors[(i, name)] = detector
+            for name, callback in db.detector_callbacks.items():
+                self.callbacks[(i, name)] = callback
+        workers = max(1, min(workers, len(self.detectors)))
+        self.assigned = {key: n % workers for n, key in enumerate(self.detectors)} # worker of each detector
+        self.attached = set(range(len(self.drones))) # drones still being fed
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.lock = Lock()
+        self.refs = [0] * (slots * len(self.drones)) # detectors still working on each slot
+        self.latest = {} # (drone index, name) => (seq, stamp, result)
+        self.processed = 0
+        self.dropped = 0
+        self.running = True
+
+        ctx = multiprocessing.get_context('spawn')
+        self.shm = shared_memory.SharedMemory(create=True, size=len(self.refs) * slot_bytes)
+        self.tasks = [ctx.Queue() for _ in range(workers)] # one queue per worker
+        self.results = ctx.Queue()
+        self.workers = []
+        for w in range(workers):
+            detectors = {key: detector for key, detector in self.detectors.items() if self.assigned[key] == w}
+            self.workers.append(ctx.Process(target=vision_worker, daemon=True,
+                                            args=(self.shm.name, slot_bytes, detectors, self.tasks[w], self.results)))
+        for worker in self.workers:
+            worker.start()
+        self.feeders = [Thread(target=self.feed, args=(i,)) for i in range(len(self.drones))]
+        self.collector = Thread(target=self.collect)
+        for feeder in self.feeders:
+            feeder.start()
+        self.collector.start()
+
+    def free_slot(self, i, count):
+        with self.lock:
+            for slot in range(i * self.slots, (i + 1) * self.slots):
+                if self.refs[slot] == 0:
+                    self.refs[slot] = count
+                    return slot
+        return None
+
+    def feed(self, i):
+        ''' Copies each new frame of drone i into shared memory and hands out tasks '''
+        db = self.drones[i]
+        names = [name for index, name in self.detectors if index == i]
+        seq = 0
+        while self.running and i in self.attached and db.exiting.get() == False and len(names) > 0:
+            new_frame = db.current_frame.wait(seq, 0.1) # not wait_for_frame(): that's the user's frame age
+            if new_frame is None:
+                continue
+            image, seq, stamp = new_frame
+            if image.nbytes > self.slot_bytes:
+                print("Frame too big for the vision pool ({} bytes)".format(image.nbytes))
+                continue
+            slot = self.free_slot(i, len(names))
+            if slot is None:
+                self.dropped += 1 # workers are busy - skip this frame
+                continue
+            buf = numpy.ndarray(image.shape, image.dtype, buffer=self.shm.buf, offset=slot * self.slot_bytes)
+            numpy.copyto(buf, image)
+            del buf
+            for name in names:
+                self.tasks[self.assigned[(i, name)]].put(((i, name), slot, seq, stamp, image.shape, image.dtype.str))
+
+    def collect(self):
+        ''' Gathers results, frees slots and calls the callbacks '''
+        while self.running and exiting.get() == False:
+            try:
+                key, slot, seq, stamp, result = self.results.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            with self.lock:
+                self.refs[slot] -= 1
+                self.processed += 1
+                # Workers can finish out of order - keep the newest
+                if key not in self.latest or self.latest[key][0] < seq:
+                    self.latest[key] = (seq, stamp, result)
+            callback = self.callbacks.get(key)
+            if callback is not None:
+                callback(seq, stamp, result)
+        self.close()
+
+    def get_result(self, name, db = None):
+        ''' Returns (seq, stamp, result) of the newest result from name (of drone db), or None '''
+        i = 0 if db is None else self.drones.index(db)
+        with self.lock:
+            return self.latest.get((i, name))
+
+    def detach(self, db):
+        ''' Stops feeding a drone's frames.  The pool stops with the last drone. '''
+        self.attached.discard(self.drones.index(db))
+        if len(self.attached) == 0:
+            self.stop()
+
+    def stop(self):
+        ''' Stops the workers and waits until everything is cleaned up '''
+        self.running = False
+        if current_thread() is not self.collector:
+            self.collector.join()
+
+    def close(self):
+        # Called by the collector thread once it is done
+        self.running = False
+        for feeder in self.feeders:
+            feeder.join()
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join(1.0)
+            if worker.is_alive():
+                worker.terminate()
+        self.shm.close()
+        self.shm.unlink()
+
+def start_vision(drones, workers = None):
+    '''
+    Starts one VisionPool for the detectors of several drones, so they
+    share worker processes instead of each starting a pool of their own.
+    '''
+    pool = VisionPool(drones, workers)
+    for db in drones:
+        db.vision = pool
+    return pool
+
+class PID(object):
+    '''
+    PID controller stepped once per new measurement.  The output is
+    clamped to +-limit and so is the integral term (anti-windup).
+    '''
+    def __init__(self, kp, ki = 0.0, kd = 0.0, limit = 100):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.limit = limit
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.last_error = None
+        self.last_stamp = None
+        self.output = 0.0
+
+    def update(self, error, stamp):
+        ''' Steps with the error measured at stamp (seconds) and returns the output '''
+        if self.last_stamp is not None and stamp <= self.last_stamp:
+            return self.output # nothing new
+        derivative = 0.0
+        if self.last_stamp is not None:
+            dt = stamp - self.last_stamp
+            self.integral += error * dt
+            if self.ki != 0:
+                bound = self.limit / abs(self.ki)
+                self.integral = max(-bound, min(bound, self.integral))
+            derivative = (error - self.last_error) / dt
+        self.last_error = error
+        self.last_stamp = stamp
+        out = self.kp * error + self.ki * self.integral + self.kd * derivative
+        self.output = max(-self.limit, min(self.limit, out))
+        return self.output
+
+class TrackingController(object):
+    '''
+    Keeps a target in the middle of the picture by sending stick
+    velocities straight to the drone at a fixed control rate.
+
+    Any detector hands in the newest target position with update()
+    (offsets from the centre, -1 to 1) or update_rect() (a pixel
+    rectangle), along with the time.monotonic() stamp of the frame it
+    came from.  Each axis has its own PID.  A measurement older than
+    stale_after seconds stops the drone (sticks to 0) and resets the
+    PIDs until the target is seen again.
+
+    stats() reports the loop rate actually achieved, how late ticks
+    were, measurement age and the current outputs.
+
+    Axes: x is 'roll' (left/right) or 'yaw', y is up/down and the
+    optional size axis moves forward/backward to keep the target at
+    target_size (fraction of the picture's area).
+    '''
+    def __init__(self, drone, rate = 20, x_axis = 'roll', x_pid = None, y_pid = None,
+                 size_pid = None, target_size = None, stale_after = 0.3, dead_band = 0.03, exit_flag = None):
+        self.drone = drone
+        self.exit_flag = exit_flag if exit_flag is not None else exiting
+        self.rate = rate
+        self.x_axis = x_axis
+        self.pids = {
+            'x': x_pid if x_pid is not None else PID(60, 0, 8, limit=50),
+            'y': y_pid if y_pid is not None else PID(60, 0, 8, limit=50),
+            'size': size_pid if size_pid is not None else PID(150, 0, 0, limit=30),
+        }
+        self.target_size = target_size
+        self.stale_after = stale_after
+        self.dead_band = dead_band
+        self.enabled = True
+        self.measurement = None # (x, y, size, stamp) - replaced whole, no lock needed
+        self.sent = {} # stick (its positive method) => last speed sent
+        self.outputs = {'x': 0, 'y': 0, 'size': 0}
+        self.ticks = 0
+        self.stale = 0 # ticks without a fresh measurement
+        self.tick_times = deque(maxlen=max(1, int(round(rate * 2))))
+        self.late = deque(maxlen=max(1, int(round(rate * 2)))) # how late each tick started (s)
+        self.running = False
+        self.thread = None
+
+    def update(self, x, y, stamp = None, size = None):
+        ''' New target position: x, y from -1 to 1 (right and down are +) '''
+        if stamp is None:
+            stamp = time.monotonic()
+        self.measurement = (x, y, size, stamp)
+
+    def update_rect(self, rect, shape, stamp = None):
+        ''' New target as an (x, y, w, h) rectangle in an image of shape (h, w, ...) '''
+        if rect is None:
+            return
+        x, y, w, h = rect
+        height, width = shape[:2]
+        cx = (x + w / 2.0) / (width / 2.0) - 1
+        cy = (y + h / 2.0) / (height / 2.0) - 1
+        self.update(cx, cy, stamp, float(w * h) / (width * height))
+
+    def toggle(self, drone = None, speed = 1):
+        ''' Turns tracking on/off (can be bound to a key) '''
+        if speed == 0:
+            return
+        self.enabled = not self.enabled
+        print("Tracking", "on" if self.enabled else "off")
+
+    def start(self):
+        if self.running:
+            return self
+        self.running = True
+        self.thread = Thread(target=self.control_loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not current_thread():
+            self.thread.join()
+        self.send(0, 0, 0)
+
+    def control_loop(self):
+        period = 1.0 / self.rate
+        next_tick = time.monotonic()
+        while self.running and self.exit_flag.get() == False:
+            now = time.monotonic()
+            self.late.append(now - next_tick)
+            self.tick_times.append(now)
+            self.ticks += 1
+            self.step(now)
+            # Fixed rate - ticks are planned from the schedule, not from
+            # when the last one ended, so the rate doesn't drift
+            next_tick += period
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.monotonic() # fell behind - don't try to catch up
+        self.running = False
+        self.send(0, 0, 0)
+
+    def step(self, now):
+        m = self.measurement
+        if not self.enabled or m is None or now - m[3] > self.stale_after:
+            if self.enabled and m is not None:
+                self.stale += 1
+            for pid in self.pids.values():
+                pid.reset()
+            self.outputs = {'x': 0, 'y': 0, 'size': 0}
+            self.send(0, 0, 0)
+            return
+        x, y, size, stamp = m
+        ox = self.pids['x'].update(self.dead(x), stamp)
+        # The picture's y runs down, the drone's up
+        oy = self.pids['y'].update(-self.dead(y), stamp)
+        osize = 0
+        if self.target_size is not None and size is not None:
+            osize = self.pids['size'].update(self.target_size - size, stamp)
+        self.outputs = {'x': ox, 'y': oy, 'size': osize}
+        self.send(ox, oy, osize)
+
+    def dead(self, error):
+        return 0.0 if abs(error) < self.dead_band else error
+
+    def send(self, x, y, size):
+        if self.x_axis == 'yaw':
+            self.stick('clockwise', 'counter_clockwise', x)
+        else:
+            self.stick('right', 'left', x)
+        self.stick('up', 'down', y)
+        self.stick('forward', 'backward', size)
+
+    def stick(self, positive, negative, value):
+        # Both methods set the same stick (left(v) is right(-v)) and
+        # tellopy keeps sending its last value, so only changes are sent
+        speed = int(round(value))
+        if self.sent.get(positive) == speed:
+            return
+        if speed >= 0:
+            getattr(self.drone, positive)(speed)
+        else:
+            getattr(self.drone, negative)(-speed)
+        self.sent[positive] = speed
+
+    def stats(self):
+        '''
+        Returns the loop's numbers: rate (Hz over the last ~2 s), late
+        (mean/max ms a tick started late), age (ms since the newest
+        measurement), ticks, stale ticks and the current outputs.
+        '''
+        times = list(self.tick_times)
+        rate = None
+        if len(times) > 1:
+            rate = round((len(times) - 1) / (times[-1] - times[0]), 1)
+        late = numpy.array(self.late) * 1000.0 if len(self.late) > 0 else numpy.zeros(1)
+        m = self.measurement
+        return {
+            'rate': rate,
+            'late_mean_ms': round(float(late.mean()), 2),
+            'late_max_ms': round(float(late.max()), 2),
+            'age_ms': round((time.monotonic() - m[3]) * 1000.0, 1) if m is not None else None,
+            'ticks': self.ticks,
+            'stale': self.stale,
+            'outputs': dict((k, round(v, 1)) for k, v in self.outputs.items()),
+        }
+
+class CommandScheduler(object):
+    '''
+    Runs timed drone commands from its own thread.  Events sit on a heap
+    keyed on time.monotonic() and are called at their instant, so the
+    timing doesn't depend on how long the video loop takes.
+
+    Queue_Items run one after another: start(item) is called when an
+    item begins and stop(item) when its time is up.  The thread starts
+    with the first item or event and exits with the program.
+    '''
+    def __init__(self, start, stop, exit_flag = None):
+        self.start_item = start
+        self.stop_item = stop
+        self.exit_flag = exit_flag if exit_flag is not None else exiting
+        self.cond = Condition()
+        self.heap = [] # (due, n, func, args)
+        self.order = itertools.count() # keeps equal due times in order
+        self.queue = deque() # Queue_Items waiting to run
+        self.enabled = False
+        self.current = None # Queue_Item running now
+        self.ready_at = None # when the next item should start
+        self.history = deque(maxlen=256) # finished Queue_Items
+        self.thread = None
+
+    def add(self, item):
+        with self.cond:
+            self.queue.append(item)
+            self.wake()
+
+    def schedule(self, delay, func, *args):
+        ''' Calls func(*args) on the scheduler thread in delay seconds '''
+        with self.cond:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.order), func, args))
+            self.wake()
+
+    def set_enabled(self, enabled):
+        '''
+        Starts or pauses the queue.  Pausing stops the running item; it
+        stays at the front of the queue and runs again when resumed.  The
+        stop is sent by the scheduler thread, so it can't overtake the
+        item's start.
+        '''
+        with self.cond:
+            if enabled == self.enabled:
+                return
+            self.enabled = enabled
+            item = self.current
+            if enabled:
+                self.ready_at = time.monotonic()
+            else:
+                self.current = None
+                self.heap = [e for e in self.heap if e[2] != self.finish]
+                if item is not None:
+                    self.heap.append((time.monotonic(), next(self.order), self.stop_item, (item,)))
+                heapq.heapify(self.heap)
+            self.wake()
+
+    def idle(self):
+        ''' True when nothing is running or waiting to run '''
+        return self.current is None and len(self.queue) == 0
+
+    def wake(self):
+        # Called with cond held
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.cond.notify()
+
+    def run(self):
+        while self.exit_flag.get() == False:
+            with self.cond:
+                item = self.next_item()
+                due = []
+                now = time.monotonic()
+                while len(self.heap) > 0 and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap))
+                if item is None and len(due) == 0:
+                    # Sleep until the next event, waking now and then to check exiting
+                    timeout = 0.5
+                    if len(self.heap) > 0:
+                        timeout = min(timeout, self.heap[0][0] - now)
+                    self.cond.wait(timeout)
+                    continue
+            # Events first: a stop from a pause must go out before the
+            # item starts again
+            for _, _, func, args in due:
+                func(*args)
+            if item is not None:
+                item.started = time.monotonic()
+                self.start_item(item)
+
+    def next_item(self):
+        # Called with cond held.  Starts the next item when it's due.
+        if not self.enabled or self.current is not None or len(self.queue) == 0:
+            return None
+        item = self.queue[0]
+        item.planned_start = max(self.ready_at, item.queued)
+        item.planned_stop = item.planned_start + item.process_time / 1000.0
+        self.current = item
+        heapq.heappush(self.heap, (item.planned_stop, next(self.order), self.finish, (item,)))
+        return item
+
+    def finish(self, item):
+        with self.cond:
+            if self.current is not item:
+                return # paused meanwhile
+            self.current = None
+            self.queue.popleft()
+        item.stopped = time.monotonic()
+        self.stop_item(item)
+        with self.cond:
+            # The next item is due when this one should have ended
+            self.ready_at = item.planned_stop
+        self.history.append(item)
+
+    def jitter(self):
+        '''
+        Returns the start and stop jitter of the finished items in ms
+        (mean and max), e.g. {'start_mean': 0.2, 'start_max': 1.1, ...}
+        '''
+        items = list(self.history)
+        if len(items) == 0:
+            return None
+        stats = {'items': len(items)}
+        for name in ('start', 'stop'):
+            ms = numpy.array([getattr(i, name + '_jitter')() for i in items]) * 1000.0
+            stats[name + '_mean'] = round(float(ms.mean()), 3)
+            stats[name + '_max'] = round(float(ms.max()), 3)
+        return stats
+
+class VideoLink(object):
+    '''
+    Connection manager for a live drone's video.  start() asks for the
+    video before the drone has even answered and probes the stream on
+    its own thread, so connecting, starting the video and opening the
+    container all overlap.
+
+    Once the video runs, a watchdog thread checks how long ago frame_grab
+    demuxed a packet (frames the frame policy skips still count).  When
+    that's more than stall_after seconds the link is marked
+    interrupted and the stream closed, so the demux in frame_grab ends;
+    frame_grab then calls reopen(), which restarts the video and opens
+    a new container.  The time from spotting the stall to the next
+    frame is observed in recovery_time (a Histogram).
+    '''
+    # The drone sends raw H.264 - say so, and only probe a little of it,
+    # or opening waits for seconds of video
+    PROBE_OPTIONS = {'probesize': '32768', 'analyzeduration': '0'}
+
+    def __init__(self, drone, current_frame, recovery_time = None, stall_after = 2.0,
+                 open_timeout = 20.0, exit_flag = None):
+        self.drone = drone
+        self.current_frame = current_frame
+        self.recovery_time = recovery_time
+        self.stall_after = stall_after
+        self.open_timeout = open_timeout
+        self.exit_flag = exit_flag if exit_flag is not None else exiting
+        self.stream = None # tellopy's VideoStream
+        self.opener = ThreadPoolExecutor(1)
+        self.interrupted = False # set by the watchdog, cleared by reopen()
+        self.recovering_since = None # when the current outage was spotted
+        self.opened_at = None
+        self.last_packet = None # set by frame_grab for every packet demuxed
+        self.stalls = 0
+        self.recoveries = 0
+        self.watchdog = None
+        current_frame.add_listener(self.frame_published)
+
+    def start(self):
+        ''' Requests the video and starts opening it; returns a Future of the container '''
+        # tellopy sends start_video for a new stream, and again as soon
+        # as the drone answers the connection request
+        self.stream = self.drone.get_video_stream()
+        return self.opener.submit(self.open_container, self.open_timeout)
+
+    def open_container(self, timeout):
+        ''' Probes the stream until it opens, timeout runs out (raises) or exiting (None) '''
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self.exit_flag.get() == False:
+            try:
+                container = av.open(self.stream, format='h264', options=self.PROBE_OPTIONS)
+                self.opened_at = time.monotonic()
+                return container
+            except Exception:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        return None
+
+    def start_watchdog(self):
+        if self.watchdog is None:
+            self.watchdog = Thread(target=self.watch, daemon=True)
+            self.watchdog.start()
+
+    def packet_age(self):
+        ''' Seconds since the newest packet (or since the video opened) '''
+        stamp = self.last_packet
+        if stamp is None or (self.opened_at is not None and self.opened_at > stamp):
+            stamp = self.opened_at
+        if stamp is None:
+            return None
+        return time.monotonic() - stamp
+
+    def watch(self):
+        while self.exit_flag.get() == False:
+            time.sleep(self.stall_after / 4)
+            age = self.packet_age()
+            if self.interrupted or self.recovering_since is not None or age is None:
+                continue
+            if age > self.stall_after:
+                print("Video stalled ({:.1f} s without video) - restarting it".format(age))
+                self.stalls += 1
+                self.interrupt()
+
+    def interrupt(self):
+        ''' Makes frame_grab's demux end, so it can reopen the video '''
+        self.interrupted = True
+        self.recovering_since = time.monotonic()
+        stream = self.stream
+        with stream.cond:
+            stream.closed = True # read() returns what's queued, then b'' (end of stream)
+            stream.cond.notify_all()
+
+    def reopen(self, container):
+        '''
+        Restarts the video after it ended or stalled.  Blocks until a new
+        container is open and returns it, or None when exiting.
+        '''
+        if self.recovering_since is None:
+            # The stream ended by itself (tellopy gives up after 5 s of
+            # nothing, or the connection dropped)
+            self.recovering_since = time.monotonic()
+            self.stalls += 1
+        try:
+            container.close()
+        except Exception:
+            pass
+        stream = self.stream
+        with stream.cond:
+            stream.queue = []
+            stream.closed = False
+            stream.wait_first_packet_in_frame = True # start again at a frame boundary
+        self.interrupted = False
+        self.last_packet = None
+        while self.exit_flag.get() == False:
+            try:
+                self.drone.start_video() # asks for SPS/PPS and a keyframe
+                container = self.open_container(self.stall_after * 2)
+            except Exception as e:
+                # Nothing to open yet (or the drone is out of reach) - keep trying
+                print("Video reopen failed ({}) - trying again".format(e))
+                time.sleep(self.stall_after / 4)
+                continue
+            if container is not None:
+                print("Video reopened after {:.1f} s".format(time.monotonic() - self.recovering_since))
+                return container
+        return None
+
+    def frame_published(self, seq):
+        # SafeFrame listener, on the grab thread
+        since = self.recovering_since
+        if since is not None and not self.interrupted and self.exit_flag.get() == False:
+            self.recovering_since = None
+            self.recoveries += 1
+            if self.recovery_time is not None:
+                self.recovery_time.observe(time.monotonic() - since)
+
+    def close(self):
+        self.current_frame.remove_listener(self.frame_published)
+        self.opener.shutdown(wait=False)
 
 class DroneB(object):
     """
@@ -74,111 +1957,353 @@ class DroneB(object):
     """
 
     def frame_grab(self, db):
-        """ Stores frames from video stream to global variable """
-        global current_frame # global video image
-        global exiting # global exit program signal
-        for packet in db.container.demux((db.vid_stream,)):
-            try:
-                for frame in packet.decode():
-                    current_frame.set(frame.to_image())
-                if exiting.get() == True:
-                    break
-            except Exception as e:
-                print("ERROR!!! {}".format(e))
+        """ Stores frames from video stream in db.current_frame """
+        current_frame = db.current_frame
+        exiting = db.exiting # this drone's exit signal
+        # Offline sources are paced to their recorded speed (unless
+        # realtime is off); the live drone stream paces itself.
+        pacer = FramePacer(db.realtime and db.source is not None, db.fps)
+        behind = 0
+        while True:
+            if db.container is None:
+                # Synthetic source - images are already decoded BGR
+                for image in db.video_source:
+                    policy = db.frame_policy # can be changed while running
+                    behind = policy.behind(pacer.wait(), 0, db.fps)
+                    if policy.want_frame(behind):
+                        current_frame.set(bgr_to_ndarray(image, db.frame_format))
+                    if exiting.get() == True:
+                        break
+            else:
+                link = db.video_link # None for offline sources
+                try:
+                    for packet in db.container.demux((db.vid_stream,)):
+                        if link is not None and link.interrupted:
+                            break # stalled - reopened below
+                        if link is not None:
+                            link.last_packet = time.monotonic()
+                        recorder = db.out_stream_writer
+                        if recorder is not None:
+                            recorder.put(packet)
+                        restreamer = db.restreamer
+                        if restreamer is not None:
+                            restreamer.put(packet)
+                        policy = db.frame_policy # can be changed while running
+                        if not policy.want_packet(packet, max(behind, policy.behind(0, db.video_backlog(), db.fps))):
+                            pacer.skip() # keeps raw H.264 (no timestamps) at its real speed
+                            continue
+                        try:
+                            t = time.perf_counter()
+                            frames = packet.decode()
+                            db.stage_hooks.done('decode', t)
+                            for frame in frames:
+                                late = pacer.wait(frame.time)
+                                behind = policy.behind(late, db.video_backlog(), db.fps)
+                                if policy.want_frame(behind):
+                                    t = time.perf_counter()
+                                    image = frame_to_ndarray(frame, db.frame_format)
+                                    db.stage_hooks.done('convert', t)
+                                    current_frame.set(image)
+                            if exiting.get() == True:
+                                break
+                        except Exception as e:
+                            print("ERROR!!! {}".format(e))
+                except Exception as e:
+                    # Demuxing itself failed (decode errors are caught above)
+                    print("Video ERROR: {}".format(e))
+                if link is not None and exiting.get() == False:
+                    # The live video ended or stalled - start it again
+                    # and carry on with the new container
+                    container = link.reopen(db.container)
+                    if container is not None:
+                        db.container = container
+                        db.vid_stream = container.streams.video[0]
+                        pacer.reset()
+                        behind = 0
+                        continue
+            # Recorded files can be replayed from the start
+            if exiting.get() == True or db.loop == False or db.container is None:
+                break
+            db.container.seek(0)
+            pacer.reset()
+        print("Frames: {}".format(db.frame_policy.stats()))
+        if db.source is not None:
+            # End of the recording - let the main loop finish too
+            db.signal_exit()
         print("*** Exiting Frame Grab Thread ***")
 
-    def start(self, custom_loop = False):
-        """ Create controller and show the video feed."""
-        global current_frame # allows the global variable defined above to be changed inside this function
-        global exiting
+    def set_frame_policy(self, mode, fps = None, catchup = 15):
+        '''
+        Chooses which frames are decoded and published: 'smooth' (all),
+        'latest' (skip late ones), 'keyframes' or 'fps' (at most fps a
+        second).  See FramePolicy.  Returns the policy for its counters.
+        '''
+        self.frame_policy = FramePolicy(mode, fps, catchup)
+        return self.frame_policy
+
+    def video_backlog(self):
+        ''' Bytes of drone video received but not yet read by the decoder '''
+        stream = self.video_input
+        if stream is None:
+            return 0
+        return sum(len(data) for data in list(stream.queue))
 
+    def start(self, custom_loop = False, threaded_display = False, window = True):
+        """
+        Create controller and show the video feed.
+        threaded_display = True shows video from a separate, rate capped
+        display thread (not on macOS, where SDL needs the main thread).
+        window = False opens no window (there is only one per process,
+        so with several drones only one of them can use it), nor does
+        headless mode (see run_headless()).
+        """
         # Start everything
+        register_drone(self)
         self.init_drone()
         self.init_controls()
-        self.init_process_queue_items()
-        self.init_window()
+        if not window or self.headless:
+            pass
+        elif threaded_display:
+            self.display_thread = Thread(target=self.display_loop)
+            self.display_thread.start()
+        else:
+            self.init_window()
 
         Thread(target=self.frame_grab, args=[self]).start() #Create a thread that runs the function frame_grab while main runs in the current thread
         
         if custom_loop == False:
-            while exiting.get() == False:
-                self.process_keyboard()  # Process keystrokes
-                lcurrent_frame = current_frame.get()
-                if lcurrent_frame != None:
+            seq = 0
+            while self.exiting.get() == False:
+                self.process_keyboard(0)  # Process keystrokes
+                new_frame = self.wait_for_frame(seq, 0.05)
+                if new_frame is not None:
+                    lcurrent_frame, seq, stamp = new_frame
                     image = self.process_frame(lcurrent_frame)
+                    self.run_frame_callbacks(image, seq, stamp)
 
                 # CV way of showing video
     #            cv2.imshow('tello', image)
     #            _ = cv2.waitKey(1) & 0xFF
 
-    def __init__(self):
-        self.prev_flight_data = None
+    def wait_for_frame(self, after_seq = 0, timeout = None):
+        '''
+        Blocks until a frame newer than after_seq has been decoded.
+        Returns (frame, seq, stamp) where stamp is the time.monotonic()
+        time it was decoded, or None on timeout or when exiting.
+        Pass the seq you got last time to never see the same frame twice.
+        '''
+        new_frame = self.current_frame.wait(after_seq, timeout)
+        if new_frame is not None:
+            self.frame_age.observe(time.monotonic() - new_frame[2])
+        return new_frame
+
+    def run_headless(self, on_frame = None, on_telemetry = None):
+        '''
+        Runs without a window until exiting: on_frame(image, seq, stamp)
+        gets every new frame as a cv2 image (read-only) and on_telemetry
+        every Telemetry sample.  Nothing is drawn or shown, so the frames
+        are only converted for your callbacks.  More callbacks can be
+        added with subscribe_frames() and subscribe_telemetry().  Set
+        DRONEB_HEADLESS=1 to run any start() program this way.
+        '''
+        self.headless = True
+        if on_frame is not None:
+            self.subscribe_frames(on_frame)
+        if on_telemetry is not None:
+            self.subscribe_telemetry(on_telemetry)
+        self.start()
+
+    def subscribe_frames(self, callback):
+        '''
+        callback(image, seq, stamp) is called by start()'s own loop (not
+        a custom one) with every new frame.  Its time is reported as the
+        'vision' stage.
+        '''
+        self.frame_callbacks.append(callback)
+
+    def unsubscribe_frames(self, callback):
+        self.frame_callbacks.remove(callback)
+
+    def run_frame_callbacks(self, image, seq, stamp):
+        if len(self.frame_callbacks) == 0:
+            return
+        start = time.perf_counter()
+        for callback in list(self.frame_callbacks):
+            try:
+                callback(image, seq, stamp)
+            except Exception as e:
+                print("ERROR in frame callback {}: {}".format(getattr(callback, '__name__', callback), e))
+        self.stage_hooks.done('vision', start)
+
+    def frames(self, timeout = 0.1):
+        '''
+        Yields (frame, seq, stamp) for every new frame until exiting.
+        With start(custom_loop = True, window = False) this is a headless
+        loop driven by a generator instead of callbacks.
+        '''
+        seq = 0
+        while self.exiting.get() == False:
+            new_frame = self.wait_for_frame(seq, timeout)
+            if new_frame is not None:
+                seq = new_frame[1]
+                yield new_frame
+
+    def __init__(self, source = None, realtime = True, loop = False, name = None,
+                 port = 9000, video_port = 6038, address = None):
+        '''
+        source lets DroneB run without a drone: the path of a recorded
+        H.264/MP4 file, 'synthetic', or any iterable of BGR images.  It
+        defaults to $DRONEB_SOURCE.  realtime = False plays it back as
+        fast as possible (for benchmarks), loop = True replays a file.
+
+        To fly several drones from one process give each its own name
+        (used in file names), local port and video_port, and the address
+        of its drone if it isn't the default 192.168.10.1.
+        '''
+        if source is None:
+            source = os.environ.get('DRONEB_SOURCE')
+        if os.environ.get('DRONEB_REALTIME') == '0':
+            realtime = False
+        self.headless = os.environ.get('DRONEB_HEADLESS') == '1' # no window, see run_headless()
+        self.frame_callbacks = [] # see subscribe_frames()
+        self.frame_policy = FramePolicy() # which frames get published, see set_frame_policy()
+        if os.environ.get('DRONEB_FRAME_POLICY'):
+            self.frame_policy = FramePolicy.parse(os.environ['DRONEB_FRAME_POLICY'])
+        self.video_input = None # tellopy's video stream (live drone only)
+        self.source = source
+        self.realtime = realtime
+        self.loop = loop
+        self.name = name # None for a single drone
+        self.current_frame = SafeFrame() # newest decoded frames, see wait_for_frame()
+        self.exiting = SafeExiting(False, exiting) # also set by the process wide exiting
+        self.fps = 30 # pace for synthetic sources and files without timestamps
+        self.container = None
+        self.vid_stream = None
+        self.video_source = None
+        self.video_link = None # VideoLink (live drone only), reopens stalled video
+        self.video_stall_after = 2.0 # seconds without a frame before the video is restarted
+        self.telemetry = TelemetryBuffer() # recent flight data, see subscribe_telemetry()
+        self.recorder = None # FlightRecorder, see start_recorder()
+        self.last_telemetry = None # newest Telemetry sample
         self.record = False
-        self.tracking = False
+        self.tracker = None # TrackingController, see start_tracking()
         self.keydown = False
         self.date_fmt = '%Y-%m-%d_%H%M%S'
         self.speed = 50
-        self.drone = tellopy.Tello()
+        if source is None:
+            self.drone = make_tello(port, video_port)
+            if address is not None:
+                self.drone.tello_addr = (address, 8889)
+        else:
+            self.drone = StubTello()
         self.wid = None
+        self.window_open = False # see init_window()
         self.show_hud = True
         self.video_format = 0 # 4 x 3 by default
+        self.frame_format = 'bgr24' # see FRAME_FORMATS ('gray' or 'y' skip colour conversion)
         self.down_camera = 0 # Dont show downward camera
         self.hud_font = None
         self.hud_color = (255,255,255)
-        self.out_file = None
-        self.out_stream = None
-        self.out_stream_writer = None
-        self.out_name = None
+        # Telemetry field, format, text shown
+        self.hud = [
+            ['height', 'ALT {0}', ''],
+            ['north_speed', 'FWD SPD {0}', ''],
+            ['east_speed', 'L/R SPD {0}', ''],
+            ['ground_speed', 'U/D SPD {0}', ''],
+            ['battery', 'BAT {0}%', ''],
+            ['wifi', 'NET {0}%', '']
+        ]
+        self.detectors = {} # name => detector run by the vision pool
+        self.detector_callbacks = {}
+        self.vision = None # VisionPool, see start_vision()
+        self.display_thread = None # see start(threaded_display = True)
+        self.display_fps = 30 # cap for the threaded display
+        self.display_events = deque() # pygame events from the display thread
+        self.display_buffer = None # BGR conversion target for gray/yuv frames
+        self.display_surface = None # pygame surface wrapping display_buffer
+        self.snapshots = None # SnapshotWriter, made by the first snapshot
+        self.snapshot_format = 'jpg' # or 'png'
+        self.snapshot_burst = 10 # frames saved by the burst key
+        self.video_rect = None # where the video sits in the window
+        self.hud_surface = None # all HUD rows, rebuilt only when hud_dirty
+        self.hud_dirty = True
+        self.hud_text_cache = OrderedDict() # (text, style) => rendered row
+        self.hud_text_cache_size = 64
+        self.out_stream_writer = None # VideoRecorder while recording
+        self.out_name = None # file being recorded to
+        self.restreamer = None # Restreamer forwarding the drone's packets
+        self.frame_streamer = None # FrameStreamer, see restream_frame()
         self.start_time = time.time()
-        self.command_queue = deque()
-        self.command_queue_enable = False
-        self.command_queue_timeout = None
-        self.command_queue_active = True
+        self.scheduler = CommandScheduler(self.start_queue_item, self.stop_queue_item, self.exiting)
+        self.command_queue = self.scheduler.queue
+        self.init_process_queue_items()
+        self.stage_hooks = StageHooks() # timing callbacks, see add_stage_hook()
+        self.profiler = None # StackSampler, see profile()
+        self.profile_seconds = 10 # length of a profile from the profile key
+        self.hud_page = 'flight' # or 'metrics', see toggle_metrics()
+        self.metrics_font = None
+        self.metrics_surface = None # metrics page, redrawn every metrics_interval
+        self.metrics_interval = 0.5
+        self.metrics_last = None # (time, frames published, telemetry samples) at the last redraw
+        self.init_metrics()
 
     def init_drone(self):
         """Connect, uneable streaming and subscribe to events"""
-        
-        # Check for errors -- often caused by not
-        # having the drone connected.
+        if self.source is not None:
+            self.init_offline_source()
+            return
+
+        start = time.monotonic()
         self.drone.connect()
+        # Ask for the video and start probing it right away, while the
+        # connection is still being made
+        self.video_link = VideoLink(self.drone, self.current_frame, self.recovery_time,
+                                    self.video_stall_after, exit_flag=self.exiting)
+        opening = self.video_link.start()
+        self.video_input = self.video_link.stream
+        # Subscribe for receiving data
+        self.drone.subscribe(self.drone.EVENT_FLIGHT_DATA, self.flight_data_handler)
 
+        # Check for errors -- often caused by not
+        # having the drone connected.
         try:
             self.drone.wait_for_connection(15.0)
         except:
             print("\nConnection To Drone Failed!\n")
-            exiting.set(True)   # Shut down correctly
-            self.drone.quit()
+            self.quit()   # Shut down correctly
             exit(0)
         # No error continue starting up
-        self.drone.start_video()
-        
-        
-        # Try 3 times before failing
-        i = 3
-        while 1 == 1:
-            try:
-                # container for processing the packets into frames
-                self.container = av.open(self.drone.get_video_stream())
-                break # No error!  keep going
-            except:
-                i -= 1
-                if i < 1:
-                    print("\nDrone Video Failed!\n")
-                    exiting.set(True)   # Shut down correctly
-                    self.drone.quit()
-                    exit(0)
-                time.sleep(0.1)
-
-        self.vid_stream = self.container.streams.video[0]
-        # Subscribe for receiving data
-        self.drone.subscribe(self.drone.EVENT_FLIGHT_DATA, self.flight_data_handler)
         # Set the camera
         self.drone.set_video_mode(self.video_format)
         cmd = 'downvision {}'.format(self.down_camera)
         self.drone.sock.sendto(bytes(cmd, 'utf-8'), self.drone.tello_addr)
 
+        # container for processing the packets into frames
+        try:
+            self.container = opening.result()
+        except Exception:
+            self.container = None
+        if self.container is None:
+            print("\nDrone Video Failed!\n")
+            self.quit()   # Shut down correctly
+            exit(0)
+        self.vid_stream = self.container.streams.video[0]
+        self.metrics.get('connect_seconds').set(time.monotonic() - start)
+        self.video_link.start_watchdog()
+
+
+    def init_offline_source(self):
+        """Open the recorded or synthetic video used instead of a drone"""
+        if isinstance(self.source, str) and self.source == 'synthetic':
+            self.video_source = SyntheticVideo().frames()
+        elif isinstance(self.source, str):
+            self.container = av.open(self.source)
+            self.vid_stream = self.container.streams.video[0]
+        else:
+            self.video_source = iter(self.source)
 
     def init_window(self):
+        self.window_open = True
         pygame.init()
         pygame.display.init()
         pygame.display.set_mode((1280, 720))
@@ -187,10 +2312,9 @@ class DroneB(object):
         # Setup the HUD font
         self.hud_font = pygame.font.SysFont("freesansbold.ttf", 50)
 
-        global wid
         if 'window' in pygame.display.get_wm_info():
-            wid = pygame.display.get_wm_info()['window']
-        print("Tello video WID:", wid)
+            self.wid = pygame.display.get_wm_info()['window']
+        print("Tello video WID:", self.wid)
 
     def init_controls(self):
         # Keyboard map - Key => Action
@@ -214,21 +2338,35 @@ class DroneB(object):
             'v': self.toggle_video,
             'c': self.toggle_command_queue,
             'x': self.toggle_downcamera,
-    #        'r': toggle_recording,
+            'r': self.toggle_recording,
+            'b': self.burst_key,
+            'm': self.toggle_metrics,
+            'f': self.profile_key,
     #        'z': toggle_zoom,
-    #        'enter': take_picture,
-    #        'return': take_picture,
+            'enter': self.snapshot_key,
+            'return': self.snapshot_key,
         }
 
-    def process_keyboard(self):
-        time.sleep(0.01)  # Pygame seems to want a slight sleep
-        for e in pygame.event.get():
+    def process_keyboard(self, delay = 0.01):
+        # Pygame seems to want a slight sleep when polled in a tight
+        # loop.  Loops that block in wait_for_frame() can pass 0.
+        if delay > 0:
+            time.sleep(delay)
+        if self.display_thread is not None:
+            # The display thread owns the window and collects events
+            events = []
+            while len(self.display_events) > 0:
+                events.append(self.display_events.popleft())
+        elif not self.window_open:
+            return # no window, no keys (and no pygame)
+        else:
+            events = pygame.event.get()
+        for e in events:
             if e.type == pygame.locals.KEYDOWN:
                 print('+' + pygame.key.name(e.key))
                 keyname = pygame.key.name(e.key)
                 if keyname == 'escape':
-                    exiting.set(True)
-                    self.drone.quit()
+                    self.quit()
                     exit(0)
                 if keyname in self.controls:
                     key_handler = self.controls[keyname]
@@ -248,46 +2386,206 @@ class DroneB(object):
                         key_handler(self.drone, 0)
 
     def process_frame(self, frame):
-        # convert frame to cv2 image and show
-        image = cv2.cvtColor(numpy.array(frame), cv2.COLOR_RGB2BGR)
+        '''
+        Shows a frame in the pygame window and returns it as a cv2 image.
+        Frames from frame_grab are already in self.frame_format, so no
+        conversion is done here.  The returned image may be a read-only
+        view; call image.copy() before drawing on it.
+        With the threaded display the window is updated on its own
+        thread, and without a window (see start(window = False)) there
+        is nothing to show, so this only returns the image.
+        '''
+        image = self.frame_to_image(frame)
+        if self.display_thread is None and self.window_open:
+            self.show_frame(image)
+#        image = self.write_hud(image)
+#        if self.record:
+#            self.record_vid(frame)
+        return image
 
-        # Rotate if its a from the down_camera
-        if(self.down_camera == 1):
+    def frame_to_image(self, frame):
+        ''' Returns the frame as a cv2 image the right way up '''
+        if isinstance(frame, numpy.ndarray):
+            image = frame
+        else:
+            # PIL image (older code) - convert frame to cv2 image
+            image = cv2.cvtColor(numpy.array(frame), cv2.COLOR_RGB2BGR)
+
+        # Rotate if its a from the down_camera (yuv420p is rotated for
+        # the window only, the stacked planes can't be rotated as is)
+        if(self.down_camera == 1 and self.frame_format != 'yuv420p'):
             image = cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+        return image
+
+    def show_frame(self, image):
+        '''
+        Blits a cv2 image into the middle of the pygame window and
+        updates just that rectangle.  BGR images are shown straight from
+        their buffer, others are converted into a persistent buffer.
+        '''
+        # The window always needs BGR
+        if self.frame_format == 'yuv420p':
+            show = cv2.cvtColor(image, cv2.COLOR_YUV2BGR_I420, dst=self.display_buffer)
+            if self.down_camera == 1:
+                show = cv2.rotate(show, cv2.ROTATE_90_CLOCKWISE)
+        elif image.ndim == 2:
+            show = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR, dst=self.display_buffer)
+        else:
+            show = numpy.ascontiguousarray(image)
 
-        pg_image = pygame.image.frombuffer(image.tostring(), image.shape[1::-1], "BGR")
+        size = show.shape[1::-1]
+        if show is self.display_buffer and self.display_surface is not None:
+            # Surface already wraps this buffer - it's up to date
+            pg_image = self.display_surface
+        else:
+            # No copy - the surface uses the image's own memory
+            pg_image = pygame.image.frombuffer(show, size, "BGR")
+            if self.frame_format == 'yuv420p' or image.ndim == 2:
+                self.display_buffer = show
+                self.display_surface = pg_image
 
         # Show video via Pygame window
+        start = time.perf_counter()
         background = pygame.display.get_surface()
-        color = (0,0,0) # Black background
-        background.fill(color)
-
-        # Get where to center video
-        x = (background.get_width() - pg_image.get_width())/2
-        y = (background.get_height() - pg_image.get_height())/2
-        # Fast Blit it to the background & flip
-        background.blit(pg_image, (x,y))
-
-        # HUD Display
-        x += 10 # minor aligning...
-        y -= 30
+        full_update = False
+        if self.video_rect is None or self.video_rect.size != size:
+            # First frame or the size changed - clear everything once
+            color = (0,0,0) # Black background
+            background.fill(color)
+            # Get where to center video
+            x = (background.get_width() - size[0]) // 2
+            y = (background.get_height() - size[1]) // 2
+            self.video_rect = pygame.Rect((x, y), size)
+            full_update = True
+        background.blit(pg_image, self.video_rect)
+
+        # HUD Display (it sits inside the video rectangle)
         if self.show_hud == True:
-            # Place text on screen
-            for val1, val2, val in self.hud:
-                txt_img = self.pretty_render(val, self.hud_font)
-                y += 40
-                background.blit(txt_img, (x,y))
-
-        # Flip the background surface to the
-        # Foreground and show
-        pygame.display.flip()
-#        image = self.write_hud(image)
-#        if self.record:
-#            self.record_vid(frame)
-        return image
+            hud_start = time.perf_counter()
+            self.draw_hud(background, self.video_rect.x, self.video_rect.y)
+            self.stage_hooks.done('hud', hud_start)
+
+        # Show what changed
+        if full_update:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.video_rect)
+        self.stage_hooks.done('display', start)
+
+    def display_loop(self):
+        '''
+        Threaded display: owns the pygame window and shows the newest
+        frame at up to display_fps, so the control/vision loop never
+        waits on SDL.  Keyboard events are handed to process_keyboard().
+        '''
+        self.init_window()
+        seq = 0
+        next_time = time.monotonic()
+        while self.exiting.get() == False:
+            self.display_events.extend(pygame.event.get())
+            new_frame = self.current_frame.wait(seq, 0.05) # frame age is only measured for the main loop
+            if new_frame is None:
+                continue
+            lcurrent_frame, seq, stamp = new_frame
+            self.show_frame(self.frame_to_image(lcurrent_frame))
+
+            # Cap the display rate
+            next_time += 1.0 / self.display_fps
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.monotonic()
+        print("*** Exiting Display Thread ***")
+
+    def draw_hud(self, background, x, y):
+        ''' Places the HUD text on the background surface at the video's x, y '''
+        if self.hud_page == 'metrics':
+            self.draw_metrics(background, x, y)
+            return
+        if self.hud_dirty or self.hud_surface is None:
+            # Clear the flag first so a change that arrives while
+            # rendering is picked up next frame
+            self.hud_dirty = False
+            self.hud_surface = self.render_hud()
+        # minor aligning...
+        background.blit(self.hud_surface, (x + 10, y + 10))
 
-    def pretty_render(self, text, font, gfcolor=pygame.Color('dodgerblue'), ocolor=(255, 255, 255), opx=2):
+    def render_hud(self):
+        ''' Composites all HUD rows into one surface, 40px apart '''
+        rows = [self.cached_render(val, self.hud_font) for val1, val2, val in self.hud]
+        return self.stack_rows(rows, 40)
+
+    def stack_rows(self, rows, spacing):
+        w = max(row.get_width() for row in rows)
+        h = spacing * (len(rows) - 1) + max(row.get_height() for row in rows)
+        surf = pygame.Surface((w, h)).convert_alpha()
+        surf.fill((0, 0, 0, 0))
+        y = 0
+        for row in rows:
+            surf.blit(row, (0, y))
+            y += spacing
+        return surf
+
+    def draw_metrics(self, background, x, y):
+        ''' The metrics page of the HUD, redrawn every metrics_interval seconds '''
+        now = time.monotonic()
+        if self.metrics_surface is None or now - self.metrics_last[0] >= self.metrics_interval:
+            if self.metrics_font is None:
+                self.metrics_font = pygame.font.SysFont("freesansbold.ttf", 30)
+            rows = [self.pretty_render(text, self.metrics_font) for text in self.metrics_text(now)]
+            self.metrics_surface = self.stack_rows(rows, 24)
+        background.blit(self.metrics_surface, (x + 10, y + 10))
+
+    def metrics_text(self, now):
+        ''' Lines of the metrics page; rates are since the last call '''
+        published = self.frame_policy.published
+        samples = self.telemetry_count.value
+        fps = hz = 0.0
+        if self.metrics_last is not None and now > self.metrics_last[0]:
+            fps = (published - self.metrics_last[1]) / (now - self.metrics_last[0])
+            hz = (samples - self.metrics_last[2]) / (now - self.metrics_last[0])
+        self.metrics_last = (now, published, samples)
+
+        def mean(h, scale):
+            count, total = h.get()
+            return total / count * scale if count else 0.0
+        policy = self.frame_policy
+        link = self.video_link
+        if link is not None and link.stalls > 0:
+            video = 'VIDEO {:.1f} FPS ({}, {} restarts)'.format(fps, policy.mode, link.stalls)
+        else:
+            video = 'VIDEO {:.1f} FPS ({})'.format(fps, policy.mode)
+        return [
+            video,
+            'DECODE {:.1f} ms  CONVERT {:.1f} ms'.format(mean(self.decode_time, 1000), mean(self.convert_time, 1000)),
+            'FRAME AGE {:.1f} ms'.format(mean(self.frame_age, 1000)),
+            'LOCK WAIT {:.0f} us'.format(mean(self.current_frame.lock_wait, 1000000)),
+            'DROPPED {}  STALE {}'.format(policy.dropped, policy.stale),
+            'BACKLOG {} bytes'.format(self.video_backlog()),
+            'QUEUE {}'.format(len(self.scheduler.queue)),
+            'TELEMETRY {:.1f} Hz'.format(hz),
+        ]
+
+    def cached_render(self, text, font, gfcolor=None, ocolor=(255, 255, 255), opx=2):
+        ''' pretty_render, remembering the most recent results (LRU) '''
+        if gfcolor is None:
+            gfcolor = pygame.Color('dodgerblue')
+        key = (text, id(font), tuple(gfcolor), tuple(ocolor), opx)
+        surf = self.hud_text_cache.get(key)
+        if surf is not None:
+            self.hud_text_cache.move_to_end(key)
+            return surf
+        surf = self.pretty_render(text, font, gfcolor, ocolor, opx)
+        self.hud_text_cache[key] = surf
+        if len(self.hud_text_cache) > self.hud_text_cache_size:
+            self.hud_text_cache.popitem(last=False)
+        return surf
+
+    def pretty_render(self, text, font, gfcolor=None, ocolor=(255, 255, 255), opx=2):
         '''Renders text with a nice background'''
+        if gfcolor is None:
+            gfcolor = pygame.Color('dodgerblue')
         textsurface = font.render(text, True, gfcolor).convert_alpha()
         w = textsurface.get_width() + 2 * opx
         h = font.get_height()
@@ -311,41 +2609,160 @@ class DroneB(object):
         cv2.CvtColor(image, image_rgb, cv2.CV_BGR2RGB)
         return pygame.image.frombuffer(image.tostring(), cv2.GetSize(image_rgb), "RGB")
 
-    # ALT:0|SPD:0|BAT:12|WIFI:0|CAM:0|MODE:6
-    hud = [
-        ['ALT', 'ALT {0}', ''],
-        ['north_speed', 'FWD SPD {0}', ''],
-        ['east_speed', 'L/R SPD {0}', ''],
-        ['SPD', 'U/D SPD {0}', ''],
-        ['BAT', 'BAT {0}%', ''],
-        ['WIFI', 'NET {0}%', '']
-    ]
-
     def flight_data_handler(self, event, sender, data):
-        '''Receives data from drone and formats for HUD'''
-        strData = str(data).replace(" ", "")
-        if self.prev_flight_data != strData:
-            self.prev_flight_data = strData
-        else:
-            return
-        hud_items = dict(x.split(":") for x in str(strData).split("|"))
-        # Add special items
-        hud_items["east_speed"] = data.east_speed
-        hud_items["north_speed"] = data.north_speed
+        '''Receives data from drone, records it and formats for HUD'''
+        sample = Telemetry(time.monotonic(), data)
+        self.last_telemetry = sample
+        self.telemetry.append(sample)
+        self.telemetry_count.inc()
         i = 0
         for item_val, fmt_str, val3 in (self.hud):
-            val = hud_items[item_val]
+            val = getattr(sample, item_val)
             if val == None:
-                self.hud[i][2] = fmt_str.format("N/A")
+                text = fmt_str.format("N/A")
             else:
-                self.hud[i][2] = fmt_str.format(val)
+                text = fmt_str.format(val)
+            if text != val3:
+                # Only re-render the HUD when something shown changed
+                self.hud[i][2] = text
+                self.hud_dirty = True
             i += 1
 
+    def subscribe_telemetry(self, callback):
+        ''' callback(sample) is called with every new Telemetry sample '''
+        self.telemetry.subscribe(callback)
+
     ####################################
     # Functions Available for core functions
     def get_exiting(self):
-        global exiting
-        return exiting.get()
+        return self.exiting.get()
+
+    def signal_exit(self):
+        ''' Tells this drone's threads to finish (and everyone, once every drone has) '''
+        self.exiting.set(True)
+        self.current_frame.close()
+        if self in drones and all(db.exiting.get() for db in drones):
+            exiting.set(True)
+
+    def quit(self):
+        ''' Signals every thread to exit and disconnects from the drone '''
+        self.signal_exit()
+        if self.vision is not None:
+            self.vision.detach(self)
+        self.stop_tracking()
+        self.drone.quit()
+        self.stop_recorder()
+        self.stop_recording()
+        self.stop_restream()
+        if self.snapshots is not None:
+            self.snapshots.close()
+        if self.profiler is not None:
+            self.profiler.stop() # writes what it has so far
+        if self.video_link is not None:
+            self.video_link.close()
+
+    def start_recorder(self, path = None):
+        '''
+        Starts logging every telemetry sample and command to a binary
+        flight log (flight_<date>.dblog by default).  Returns its path.
+        '''
+        if self.recorder is not None:
+            return self.recorder.path
+        if path is None:
+            path = 'flight_{}{}.dblog'.format(self.name + '_' if self.name else '',
+                                              datetime.now().strftime(self.date_fmt))
+        self.recorder = FlightRecorder(path, exit_flag=self.exiting)
+        self.telemetry.subscribe(self.recorder.log_telemetry)
+        self.drone = RecordedDrone(self.drone, self.recorder)
+        if self.tracker is not None:
+            self.tracker.drone = self.drone
+        return path
+
+    def stop_recorder(self):
+        if self.recorder is None:
+            return
+        self.telemetry.unsubscribe(self.recorder.log_telemetry)
+        self.drone = self.drone.drone
+        if self.tracker is not None:
+            self.tracker.drone = self.drone
+        self.recorder.close()
+        self.recorder = None
+
+    def add_detector(self, name, detector, callback = None):
+        '''
+        Registers a vision detector to run in the worker processes.
+        detector(image) gets every frame it has time for (read-only, as
+        decoded) and its result is returned by get_vision_result(name).
+        callback(seq, stamp, result) is also called, on a background
+        thread, for every result.  Register before start_vision().
+        '''
+        self.detectors[name] = detector
+        if callback is not None:
+            self.detector_callbacks[name] = callback
+
+    def start_vision(self, workers = None):
+        '''
+        Starts the worker processes for the registered detectors.  To
+        share one pool between several drones use start_vision(drones).
+        '''
+        self.vision = VisionPool([self], workers)
+
+    def get_vision_result(self, name):
+        ''' Returns (seq, stamp, result) of the newest result from a detector, or None '''
+        if self.vision is None:
+            return None
+        return self.vision.get_result(name, self)
+
+    def start_tracking(self, rate = 20, **kwargs):
+        '''
+        Starts a TrackingController that flies the drone towards the
+        target positions given to its update()/update_rect().  Extra
+        arguments go to TrackingController (gains, axes, stale_after).
+        '''
+        if self.tracker is None:
+            self.tracker = TrackingController(self.drone, rate, exit_flag=self.exiting, **kwargs)
+        return self.tracker.start()
+
+    def stop_tracking(self):
+        if self.tracker is None:
+            return
+        self.tracker.stop()
+        self.tracker = None
+
+    def snapshot_key(self, drone, speed):
+        if speed == 0:
+            return
+        self.snapshot()
+
+    def burst_key(self, drone, speed):
+        if speed == 0:
+            return
+        self.burst()
+
+    def get_snapshots(self):
+        if self.snapshots is None:
+            prefix = 'snapshot' if self.name is None else self.name + '-snapshot'
+            self.snapshots = SnapshotWriter(fmt=self.snapshot_format, prefix=prefix, exit_flag=self.exiting)
+        return self.snapshots
+
+    def snapshot(self):
+        '''
+        Saves the newest decoded frame to snapshot-<date>-<seq>.jpg in
+        the background.  Returns a Future for the path, or None if
+        there is no frame yet.
+        '''
+        frame, seq = self.current_frame.get_latest()
+        if frame is None:
+            return None
+        return self.get_snapshots().save(frame, seq, self.frame_format, self.down_camera == 1)
+
+    def burst(self, count = None):
+        ''' Saves the next count (snapshot_burst) frames at full rate '''
+        if count is None:
+            count = self.snapshot_burst
+        frame, seq = self.current_frame.get_latest()
+        return self.get_snapshots().burst(self.current_frame, count, self.frame_format,
+            self.down_camera == 1, seq)
 
     def take_picture(self, drone, speed):
         if speed == 0:
@@ -362,6 +2779,14 @@ class DroneB(object):
             return
         self.show_hud = not self.show_hud
 
+    def toggle_metrics(self, drone, speed):
+        # Swap the HUD between flight data and the metrics page
+        if speed == 0:
+            return
+        self.hud_page = 'metrics' if self.hud_page == 'flight' else 'flight'
+        self.metrics_surface = None
+        self.hud_dirty = True
+
 
     def toggle_video(self, drone, speed):
         if speed == 0:
@@ -377,71 +2802,256 @@ class DroneB(object):
         cmd = 'downvision {}'.format(self.down_camera)
         self.drone.sock.sendto(bytes(cmd, 'utf-8'), self.drone.tello_addr)
 
+    def toggle_recording(self, drone, speed):
+        if speed == 0:
+            return
+        if self.record:
+            self.stop_recording()
+        else:
+            self.start_recording()
+
+    def start_recording(self, path = None):
+        '''
+        Starts recording the video as it comes from the drone (no
+        re-encoding) to tello-<date>.mp4, or path (.mp4 or .mkv)
+        '''
+        if self.record:
+            return self.out_name
+        if self.vid_stream is None:
+            print("Recording needs an H.264 video source")
+            return None
+        if path is None:
+            path = '{}-{}.mp4'.format(self.name or 'tello', datetime.now().strftime(self.date_fmt))
+        self.out_name = path
+        self.out_stream_writer = VideoRecorder(path, self.vid_stream, exit_flag=self.exiting)
+        self.record = True
+        print("Recording to", path)
+        return path
+
+    def stop_recording(self):
+        if not self.record:
+            return
+        recorder = self.out_stream_writer
+        self.record = False
+        self.out_stream_writer = None
+        recorder.close()
+        print("Saved {} ({} packets, {} dropped)".format(self.out_name, recorder.written, recorder.dropped))
+
+    def start_restream(self, url = 'udp://127.0.0.1:23000', reencode = False, width = 960, height = 720, **kwargs):
+        '''
+        Streams the video as MPEG-TS to url (udp://host:port or
+        rtp://host:port).  By default the drone's H.264 packets are
+        forwarded as they are.  reencode = True instead streams whatever
+        images are passed to restream_frame() (e.g. with detections drawn
+        on them), encoded in-process at width x height.  Extra arguments
+        go to FrameStreamer (fps, codec, bit_rate, max_queue).
+        '''
+        if reencode:
+            if self.frame_streamer is None:
+                self.frame_streamer = FrameStreamer(url, width, height, exit_flag=self.exiting, **kwargs)
+            return self.frame_streamer
+        if self.restreamer is None:
+            if self.vid_stream is None:
+                print("Restreaming needs an H.264 video source (or reencode = True)")
+                return None
+            self.restreamer = Restreamer(url, self.vid_stream, exit_flag=self.exiting)
+        print("Streaming to", url)
+        return self.restreamer
+
+    def restream_frame(self, image, stamp = None):
+        ''' Sends an image to the re-encoded stream, never waiting on it '''
+        if self.frame_streamer is not None:
+            self.frame_streamer.put(image, stamp)
+
+    def stop_restream(self):
+        for streamer in (self.restreamer, self.frame_streamer):
+            if streamer is not None:
+                streamer.close()
+                print("Streamed to {} ({} sent, {} dropped)".format(streamer.path, streamer.written, streamer.dropped))
+        self.restreamer = None
+        self.frame_streamer = None
+
+    def init_metrics(self):
+        '''
+        Registers this drone's metrics.  Hot paths only do an add or a
+        bisect (see Counter and Histogram); anything already counted
+        elsewhere is read when scraped instead.
+        '''
+        m = self.metrics = Metrics({'drone': self.name or 'tello'})
+        m.counter('frames_decoded_total', 'Video frames decoded', lambda: self.frame_policy.decoded)
+        m.counter('frames_published_total', 'Video frames published to current_frame', lambda: self.frame_policy.published)
+        m.counter('frames_dropped_total', 'Video frames skipped by the frame policy', lambda: self.frame_policy.dropped)
+        m.counter('frames_stale_total', 'Video frames skipped for arriving too late', lambda: self.frame_policy.stale)
+        m.counter('telemetry_samples_total', 'Flight data samples received')
+        m.counter('vision_processed_total', 'Frames run through the vision pool (all drones)',
+                  lambda: self.vision.processed if self.vision is not None else None)
+        m.counter('vision_dropped_total', 'Frames skipped by a busy vision pool (all drones)',
+                  lambda: self.vision.dropped if self.vision is not None else None)
+        m.gauge('command_queue_depth', 'Items waiting in the command queue', lambda: len(self.scheduler.queue))
+        m.gauge('video_backlog_bytes', 'Drone video received but not yet decoded', self.video_backlog)
+        self.decode_time = m.histogram('decode_seconds', 'Time to decode one video packet')
+        self.convert_time = m.histogram('convert_seconds', 'Time to convert a decoded frame to an image')
+        m.histogram('display_seconds', 'Time to show a frame in the window (HUD included)')
+        m.histogram('hud_seconds', 'Time to draw the HUD')
+        m.histogram('command_queue_seconds', 'Time to send one command queue action')
+        m.histogram('vision_seconds', 'Time spent in code timed with timed(\'vision\')')
+        for stage in STAGES:
+            self.stage_hooks.add(stage, self.observe_stage)
+        self.frame_age = m.histogram('frame_age_seconds', 'Age of frames when wait_for_frame() returns them',
+                                     (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+        m.counter('video_stalls_total', 'Times the live video stalled or ended',
+                  lambda: self.video_link.stalls if self.video_link is not None else None)
+        m.counter('video_recoveries_total', 'Times the live video was reopened and frames resumed',
+                  lambda: self.video_link.recoveries if self.video_link is not None else None)
+        self.recovery_time = m.histogram('video_recovery_seconds', 'Time from spotting a stalled video to its next frame',
+                                         (0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+        m.gauge('connect_seconds', 'Time from connect() to the video being open').set(None) # set by init_drone()
+        m.gauge('frame_age_now_seconds', 'Seconds since the newest frame was published',
+                lambda: time.monotonic() - self.current_frame.stamp if self.current_frame.stamp is not None else None)
+        self.current_frame.lock_wait = m.histogram('frame_lock_wait_seconds', 'Time SafeFrame.set() waits for its lock',
+                                                   (0.000001, 0.00001, 0.0001, 0.001, 0.01))
+        self.telemetry_count = m.get('telemetry_samples_total')
+
+    def observe_stage(self, stage, seconds):
+        # Stage hook feeding the <stage>_seconds histograms
+        self.metrics.get(stage + '_seconds').observe(seconds)
+
+    def add_stage_hook(self, stage, callback):
+        '''
+        Calls callback(stage, seconds) every time stage finishes.  Stages
+        are in STAGES: decode and convert (frame grab thread), display
+        and hud (whichever thread shows the video), command_queue
+        (scheduler thread) and vision (your own code, see timed()).
+        '''
+        self.stage_hooks.add(stage, callback)
+
+    def remove_stage_hook(self, stage, callback):
+        self.stage_hooks.remove(stage, callback)
+
+    def timed(self, stage = 'vision'):
+        '''
+        Times a block of your own code as a stage:
+            with db.timed('vision'):
+                rect = finder.find(image)
+        '''
+        return self.stage_hooks.timed(stage)
+
+    def profile(self, seconds = None, path = None):
+        '''
+        Samples every thread's stack for seconds (profile_seconds by
+        default) without stopping anything, then writes them as collapsed
+        stacks to profile_<date>.folded, or path.  Returns the StackSampler.
+        '''
+        if self.profiler is not None and self.profiler.running:
+            return self.profiler
+        if path is None:
+            path = 'profile_{}{}.folded'.format(self.name + '_' if self.name else '',
+                                                datetime.now().strftime(self.date_fmt))
+        print("Profiling for {} s".format(seconds or self.profile_seconds))
+        self.profiler = StackSampler(path, seconds or self.profile_seconds, exit_flag=self.exiting)
+        return self.profiler
+
+    def profile_key(self, drone, speed):
+        if speed == 0:
+            return
+        self.profile()
+
+    def start_metrics_server(self, port = 9100, host = '127.0.0.1'):
+        ''' Serves this drone's metrics at http://host:port/metrics (Prometheus format) '''
+        server = start_metrics_server(self, port, host)
+        print("Metrics at http://{}:{}/metrics".format(host, port))
+        return server
+
     def toggle_command_queue(self, drone, speed):
         # Enable processing items off the queue
         if speed == 0:
             return
         self.command_queue_enable = not self.command_queue_enable
 
+    @property
+    def command_queue_enable(self):
+        return self.scheduler.enabled
+
+    @command_queue_enable.setter
+    def command_queue_enable(self, enabled):
+        self.scheduler.set_enabled(enabled)
+
+    @property
+    def command_queue_active(self):
+        # True while an item is being flown
+        return self.scheduler.current is not None
 
-    # Maps Commands to Keystrokes
+    # Maps Commands to drone actions
     def init_process_queue_items(self):
-        # Keyboard map - Key => Action
-        # Action can be a string or method
+        # Command => Action, called with the speed to start and 0 to stop
+        # Action can be a string (drone method) or method
         self.queue_items = {
-            'forward': pygame.K_w,
-            'backward': pygame.K_s,
-            'left': pygame.K_a,
-            'right': pygame.K_d,
-            'yaw_left': pygame.K_LEFT,
-            'yaw_right': pygame.K_RIGHT,
-            'up': pygame.K_UP,
-            'down': pygame.K_DOWN,
-            'takeoff': pygame.K_TAB,
-            'land': pygame.K_BACKSPACE,
+            'forward': 'forward',
+            'backward': 'backward',
+            'left': 'left',
+            'right': 'right',
+            'yaw_left': lambda drone, speed: drone.counter_clockwise(speed*2),
+            'yaw_right': lambda drone, speed: drone.clockwise(speed*2),
+            'up': 'up',
+            'down': 'down',
+            'takeoff': lambda drone, speed: drone.takeoff() if speed else None,
+            'land': lambda drone, speed: drone.land() if speed else None,
         }
 
-    def process_command_queue(self):
-        if not self.command_queue_enable:
-            self.command_queue_timeout = None
-            return
+    def start_queue_item(self, item):
+        self.run_queue_item(item, self.speed)
 
-        # Has time expired with a running queue item?
-        if not self.command_queue_timeout == None:
-            if self.command_queue_timeout < datetime.today():
-                # Current item has expired
-                self.command_queue_timeout = None
-                new_item = self.command_queue[0]
-                self.command_queue_active = False
-                pygame.event.post(pygame.event.Event(pygame.KEYUP, key=new_item.process))
+    def stop_queue_item(self, item):
+        self.run_queue_item(item, 0)
+        if item.stopped is None:
+            return # paused part way through
+        print("Queue: {} {} ms (start {:+.1f} ms, stop {:+.1f} ms)".format(
+            item.name, item.process_time, item.start_jitter() * 1000, item.stop_jitter() * 1000))
 
-                self.command_queue.popleft()
+    def run_queue_item(self, item, speed):
+        # Runs on the scheduler thread
+        action = item.process
+        start = time.perf_counter()
+        try:
+            if type(action) == str:
+                getattr(self.drone, action)(speed)
             else:
-                # Continue processing item
-
-                return
-
-        # Process the command queue if an item is available
-        if len(self.command_queue) > 0:
-            # Keep the item on the queue until done
-            # processing with a simple peek
-            new_item = self.command_queue[0]
-
-            # Process new item
-            self.command_queue_active = True
-            pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=new_item.process))
+                action(self.drone, speed)
+        except Exception as e:
+            print("ERROR running {}: {}".format(item.name, e))
+        self.stage_hooks.done('command_queue', start)
 
-            # Set New timeout
-            dt = datetime.today()
-            self.command_queue_timeout = dt + timedelta(milliseconds=new_item.process_time)
+    def process_command_queue(self):
+        '''
+        Nothing to do - the scheduler thread runs the queue by itself.
+        Kept so older loops that call it still work.
+        '''
+        pass
 
     def AddNewQueueItem(self, process, process_time_in_miliseconds = 500):
         ''' Method to add new items to the queue '''
         if process != None and process_time_in_miliseconds != None and process in self.queue_items:
-            self.command_queue.append(Queue_Item(self.queue_items[process], process_time_in_miliseconds))
+            item = Queue_Item(self.queue_items[process], process_time_in_miliseconds)
+            item.name = process
+            self.scheduler.add(item)
 
 
 class Queue_Item():
     def __init__(self, process, process_time, arg1 = None, arg2 = None):
         self.process = process
-        self.process_time = process_time
\ No newline at end of file
+        self.process_time = process_time
+        self.name = None
+        # time.monotonic() instants, filled in by the CommandScheduler
+        self.queued = time.monotonic()
+        self.planned_start = None
+        self.planned_stop = None
+        self.started = None
+        self.stopped = None
+
+    def start_jitter(self):
+        ''' How late the item started, in seconds '''
+        return self.started - self.planned_start
+
+    def stop_jitter(self):
+        ''' How late the item stopped, in seconds '''
+        return self.stopped - self.planned_stop
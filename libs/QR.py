@@ -1,20 +1,103 @@
-
 import cv2
+import numpy
+
+
+class QRReader(object):
+    """Reads QR codes from a stream of video frames.
+
+    The detector is created once and kept.  Codes are located on a
+    downscaled copy of the frame and only the located quads are decoded,
+    at full resolution.  A code whose quad hasn't moved since the last
+    frame isn't decoded again (a DroneB vision pool runs a reader in one
+    worker, so the cache sees every frame).  Several codes per frame are
+    supported.
+
+    Args:
+        scale (float): size of the image codes are located on (0.5 = half)
+        tolerance (float): how far (in pixels) a quad's corners can move
+            and still count as the same code
+    """
+
+    def __init__(self, scale=0.5, tolerance=4.0):
+        self.scale = scale
+        self.tolerance = tolerance
+        self.detector = None  # made on first use so a reader can be pickled
+        self.known = []  # [(points, text)] decoded on the last frame
+
+    def read(self, image):
+        """Read every QR code in an image.
+
+        Args:
+            image (cv2 image): BGR or gray image to analyze
+
+        Returns:
+            codes (list): (text, points) for each code, points being its
+                four corners as a 4x2 array
+        """
+        if self.detector is None:
+            # The ArUco based detector finds several codes at once (OpenCV 4.8+)
+            if hasattr(cv2, 'QRCodeDetectorAruco'):
+                self.detector = cv2.QRCodeDetectorAruco()
+            else:
+                self.detector = cv2.QRCodeDetector()
+
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        small = gray
+        if self.scale != 1:
+            small = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        try:
+            found, quads = self.detector.detectMulti(small)
+        except cv2.error:
+            found = False
+        if not found or quads is None:
+            self.known = []
+            return []
+
+        codes = []
+        for quad in quads.reshape(-1, 4, 2) / self.scale:
+            text = self.cached_text(quad)
+            if text is None:
+                try:
+                    text, _ = self.detector.decode(gray, quad.reshape(1, 4, 2).astype(numpy.float32))[:2]
+                except cv2.error:
+                    text = ''
+            codes.append((text, quad))
+        # Only remember codes that actually decoded
+        self.known = [(quad, text) for text, quad in codes if text]
+        return codes
+
+    def cached_text(self, quad):
+        """Returns the text of a known code at (almost) the same place, or None."""
+        for points, text in self.known:
+            if numpy.abs(points - quad).max() <= self.tolerance:
+                return text
+        return None
+
+    def __call__(self, image):
+        # Lets a QRReader be registered as a DroneB detector
+        return self.read(image)
+
+
+_reader = None
 
 
 def read_qr_code(image):
     """Read an image and return the QR code.
-    
+
     Args:
         image (cv2 image): Image to analyze for QR Code
-    
+
     Returns:
-        qr (string): Value from QR code
+        qr (tuple): (value, points) of the first QR code found,
+            ('', None) if there is none
     """
-    
+    global _reader
     try:
-        detect = cv2.QRCodeDetector()
-        value, points, _ = detect.detectAndDecode(image)
-        return (value, points)
+        if _reader is None:
+            _reader = QRReader()
+        codes = _reader.read(image)
+        if len(codes) == 0:
+            return ('', None)
+        return codes[0]
     except:
-        return None
\ No newline at end of file
+        return None
@@ -0,0 +1,81 @@
+'''
+Writing flight logs with FlightRecorder and reading them back.
+Run with:  python -m pytest tests
+'''
+import os
+import sys
+import time
+from types import SimpleNamespace
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from libs.DroneBLib import (FlightRecorder, Telemetry, SafeExiting, read_flight_log,
+                            LOG_TELEMETRY, LOG_COMMAND, LOG_HEADER, LOG_DTYPE)
+
+def flight_data(height):
+    # The fields Telemetry takes from tellopy's FlightData
+    return SimpleNamespace(height=height, north_speed=1, east_speed=-2, ground_speed=3,
+                           battery_percentage=87, wifi_strength=90, camera_state=0,
+                           fly_mode=6, fly_time=1234)
+
+def make_recorder(path, capacity = 4):
+    return FlightRecorder(path, flush_interval=0.02, capacity=capacity, exit_flag=SafeExiting(False))
+
+def wait_for_records(path, count, timeout = 5.0):
+    # The recorder's thread writes the records a little later
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            log = read_flight_log(path)
+            if len(log) >= count:
+                return log
+        except ValueError:
+            pass # header not written yet
+        time.sleep(0.01)
+    raise AssertionError("{} records not written".format(count))
+
+def test_round_trip_grows_past_capacity(tmp_path):
+    path = str(tmp_path / 'flight.dblog')
+    recorder = make_recorder(path)
+    for n in range(10):
+        recorder.log_command('forward', n * 10)
+        recorder.log_telemetry(Telemetry(100.0 + n, flight_data(n)))
+    recorder.log_command('land')
+    recorder.close()
+
+    # 21 records don't fit in 4: the file was grown, then trimmed
+    assert recorder.capacity >= 21
+    assert os.path.getsize(path) == LOG_HEADER + 21 * LOG_DTYPE.itemsize
+    log = read_flight_log(path)
+    assert len(log) == 21
+    commands = log[log['kind'] == LOG_COMMAND]
+    assert list(commands['name']) == [b'forward'] * 10 + [b'land']
+    assert list(commands['value']) == [n * 10.0 for n in range(10)] + [0.0]
+    telemetry = log[log['kind'] == LOG_TELEMETRY]
+    assert list(telemetry['height']) == list(range(10))
+    assert list(telemetry['stamp']) == [100.0 + n for n in range(10)]
+    assert telemetry['battery'][0] == 87
+    assert telemetry['fly_time'][0] == 1234
+
+def test_readable_while_recording(tmp_path):
+    path = str(tmp_path / 'flight.dblog')
+    recorder = make_recorder(path)
+    recorder.log_command('takeoff')
+    assert list(wait_for_records(path, 1)['name']) == [b'takeoff']
+    for n in range(5):
+        recorder.log_command('up', 20)
+    assert len(wait_for_records(path, 6)) == 6
+    recorder.close()
+
+def test_long_names_are_cut(tmp_path):
+    path = str(tmp_path / 'flight.dblog')
+    recorder = make_recorder(path)
+    recorder.log_command('counter_clockwise', 45)
+    recorder.close()
+    assert read_flight_log(path)['name'][0] == b'counter_clockwi'
+
+def test_rejects_other_files(tmp_path):
+    path = str(tmp_path / 'other.bin')
+    with open(path, 'wb') as f:
+        f.write(b'\0' * (LOG_HEADER + 10))
+    with pytest.raises(ValueError):
+        read_flight_log(path)
@@ -0,0 +1,105 @@
+'''
+Which packets and frames each FramePolicy lets through, and offline
+playback speed when frames are skipped.
+Run with:  python -m pytest tests
+'''
+import os
+import sys
+import time
+import av
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from libs.DroneBLib import DroneB, FramePolicy, FramePacer, SyntheticVideo
+
+def packet(keyframe, size = 1000):
+    p = av.Packet(bytes(size))
+    p.is_keyframe = keyframe
+    return p
+
+GOP = [True] + [False] * 9 # a keyframe every 10 frames
+
+def test_smooth_publishes_everything():
+    policy = FramePolicy()
+    for key in GOP:
+        assert policy.want_packet(packet(key), 100)
+        assert policy.want_frame(100)
+    assert policy.stats() == {'mode': 'smooth', 'decoded': 10, 'published': 10,
+                              'dropped': 0, 'stale': 10}
+
+def test_keyframes_only_decodes_keyframes():
+    policy = FramePolicy('keyframes')
+    wanted = [policy.want_packet(packet(key), 0) for key in GOP * 2]
+    assert wanted == GOP * 2
+    assert policy.dropped == 18
+    assert policy.want_packet(packet(False, 0), 0) # flush packets always go to the decoder
+
+def test_latest_drops_late_frames():
+    policy = FramePolicy('latest')
+    assert policy.want_frame(0)
+    assert policy.want_frame(0.5)
+    assert not policy.want_frame(1) # a newer frame is already waiting
+    assert (policy.published, policy.dropped, policy.stale) == (2, 1, 1)
+
+def test_latest_skips_to_the_next_keyframe_when_far_behind():
+    policy = FramePolicy('latest', catchup=15)
+    assert policy.want_packet(packet(False), 14)
+    # Too far behind: everything up to the next keyframe is dropped,
+    # even once the backlog looks smaller
+    assert not policy.want_packet(packet(False), 15)
+    assert not policy.want_packet(packet(False), 0)
+    assert policy.want_packet(packet(True), 0)
+    assert policy.want_packet(packet(False), 0)
+    assert (policy.dropped, policy.stale) == (2, 2)
+
+def test_fps_keeps_to_its_rate():
+    policy = FramePolicy('fps', 10)
+    now = 100.0
+    published = [policy.want_frame(0, now + n / 30.0) for n in range(30)] # one second at 30 fps
+    assert sum(published) == 10
+    # After a pause it carries on at 10 fps instead of catching up
+    published = [policy.want_frame(0, now + 5 + n / 30.0) for n in range(6)]
+    assert published == [True, False, False, True, False, False]
+
+def test_parse():
+    policy = FramePolicy.parse('fps:12.5')
+    assert (policy.mode, policy.fps) == ('fps', 12.5)
+    assert FramePolicy.parse('latest').mode == 'latest'
+    with pytest.raises(ValueError):
+        FramePolicy.parse('fastest')
+    with pytest.raises(ValueError):
+        FramePolicy.parse('fps')
+
+def test_pacer_counts_skipped_frames():
+    pacer = FramePacer(realtime=True, fps=100)
+    pacer.wait()
+    t = time.monotonic()
+    for n in range(9):
+        pacer.skip()
+    pacer.wait() # frame 10 is due 0.1 s after frame 0
+    assert time.monotonic() - t >= 0.09
+
+def test_raw_h264_plays_in_real_time_with_keyframes_policy(tmp_path):
+    # Raw H.264 (what the drone sends) has no timestamps to pace by
+    clip = str(tmp_path / 'clip.h264')
+    out = av.open(clip, 'w', format='h264')
+    stream = out.add_stream('h264', rate=30)
+    stream.width = 320
+    stream.height = 240
+    stream.pix_fmt = 'yuv420p'
+    stream.options = {'g': '10', 'bf': '0'}
+    for image in SyntheticVideo(320, 240, 30).frames():
+        for p in stream.encode(av.VideoFrame.from_ndarray(image, 'bgr24')):
+            out.mux(p)
+    for p in stream.encode():
+        out.mux(p)
+    out.close()
+
+    db = DroneB(source=clip, realtime=True)
+    db.set_frame_policy('keyframes')
+    db.init_drone()
+    t = time.monotonic()
+    db.frame_grab(db) # returns at the end of the clip
+    elapsed = time.monotonic() - t
+    db.quit()
+    assert db.frame_policy.published == 3
+    assert elapsed >= 0.6 # the third keyframe is frame 20, 0.67 s in
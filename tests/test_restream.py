@@ -0,0 +1,52 @@
+'''
+Recording and restreaming the same video while frame_grab decodes it.
+Run with:  python -m pytest tests
+'''
+import os
+import sys
+import socket
+import av
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from libs.DroneBLib import DroneB, SyntheticVideo
+
+FRAMES = 60
+
+def make_clip(path, width = 320, height = 240, count = FRAMES):
+    out = av.open(path, 'w')
+    stream = out.add_stream('h264', rate=30)
+    stream.width = width
+    stream.height = height
+    stream.pix_fmt = 'yuv420p'
+    for image in SyntheticVideo(width, height, count).frames():
+        for packet in stream.encode(av.VideoFrame.from_ndarray(image, 'bgr24')):
+            out.mux(packet)
+    for packet in stream.encode():
+        out.mux(packet)
+    out.close()
+
+def free_udp_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def test_record_and_restream_decode_every_frame(tmp_path):
+    clip = str(tmp_path / 'clip.mp4')
+    make_clip(clip)
+    recording = str(tmp_path / 'recording.mp4')
+
+    db = DroneB(source=clip, realtime=False)
+    db.init_drone()
+    db.start_recording(recording)
+    restreamer = db.start_restream('udp://127.0.0.1:{}'.format(free_udp_port()))
+    db.frame_grab(db) # returns at the end of the clip
+    db.quit()
+
+    # Every frame still decoded while both writers had its packets
+    assert db.frame_policy.decoded == FRAMES
+    assert db.frame_policy.published == FRAMES
+    assert restreamer.written == FRAMES
+    assert restreamer.dropped == 0
+    with av.open(recording) as container:
+        assert sum(1 for frame in container.decode(video=0)) == FRAMES
@@ -0,0 +1,92 @@
+'''
+Ordering of the CommandScheduler's items, pauses and timed events.
+Run with:  python -m pytest tests
+'''
+import os
+import sys
+import time
+from threading import current_thread
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from libs.DroneBLib import CommandScheduler, Queue_Item, SafeExiting
+
+class Calls(object):
+    ''' Records start/stop calls and the thread they came from '''
+    def __init__(self):
+        self.calls = []
+        self.threads = set()
+    def start(self, item):
+        self.calls.append(('start', item.name))
+        self.threads.add(current_thread())
+    def stop(self, item):
+        self.calls.append(('stop', item.name))
+        self.threads.add(current_thread())
+
+def make_scheduler():
+    calls = Calls()
+    return CommandScheduler(calls.start, calls.stop, SafeExiting(False)), calls
+
+def make_item(name, ms):
+    item = Queue_Item(None, ms)
+    item.name = name
+    return item
+
+def wait_until(test, timeout = 5.0):
+    deadline = time.monotonic() + timeout
+    while not test():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+def test_items_run_one_after_another():
+    scheduler, calls = make_scheduler()
+    for name in 'abc':
+        scheduler.add(make_item(name, 20))
+    scheduler.set_enabled(True)
+    wait_until(scheduler.idle)
+    assert calls.calls == [('start', 'a'), ('stop', 'a'), ('start', 'b'), ('stop', 'b'),
+                           ('start', 'c'), ('stop', 'c')]
+    # Each started when the one before should have stopped
+    items = list(scheduler.history)
+    for before, after in zip(items, items[1:]):
+        assert after.planned_start == before.planned_stop
+    scheduler.exit_flag.set(True)
+
+def test_pause_stops_the_item_and_resume_runs_it_again():
+    scheduler, calls = make_scheduler()
+    scheduler.add(make_item('a', 300))
+    scheduler.add(make_item('b', 10))
+    scheduler.set_enabled(True)
+    wait_until(lambda: len(calls.calls) == 1)
+    scheduler.set_enabled(False)
+    wait_until(lambda: len(calls.calls) == 2)
+    assert calls.calls == [('start', 'a'), ('stop', 'a')]
+    time.sleep(0.05)
+    assert len(calls.calls) == 2 # nothing runs while paused
+
+    scheduler.set_enabled(True)
+    wait_until(scheduler.idle)
+    assert calls.calls == [('start', 'a'), ('stop', 'a'), ('start', 'a'), ('stop', 'a'),
+                           ('start', 'b'), ('stop', 'b')]
+    # Stops from pausing come from the scheduler thread too
+    assert calls.threads == {scheduler.thread}
+    scheduler.exit_flag.set(True)
+
+def test_pause_right_after_start_never_stops_first():
+    for n in range(50):
+        scheduler, calls = make_scheduler()
+        scheduler.add(make_item('a', 1000))
+        scheduler.set_enabled(True)
+        scheduler.set_enabled(False)
+        wait_until(lambda: len(calls.calls) != 1) # a start is always followed by its stop
+        # Either it never started, or it started and was stopped - in that order
+        assert calls.calls in ([], [('start', 'a'), ('stop', 'a')])
+        scheduler.exit_flag.set(True)
+
+def test_events_run_in_time_order():
+    scheduler, calls = make_scheduler()
+    order = []
+    scheduler.schedule(0.04, order.append, 'late')
+    scheduler.schedule(0.01, order.append, 'early')
+    scheduler.schedule(0.01, order.append, 'early too')
+    wait_until(lambda: len(order) == 3)
+    assert order == ['early', 'early too', 'late']
+    scheduler.exit_flag.set(True)